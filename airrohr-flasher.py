@@ -4,19 +4,15 @@
 import sys
 import os.path
 import time
-import tempfile
-import hashlib
-import zlib
 import logging
-import re
-import zipfile
-import base64
 import os
-
+import json
+import collections
 from datetime import datetime
+import concurrent.futures
+import functools
+
 import requests
-from requests.auth import HTTPBasicAuth
-import serial
 from esptool import ESPLoader, erase_flash
 
 import airrohrFlasher
@@ -24,16 +20,37 @@ import random
  
 
 from airrohrFlasher.qtvariant import QtGui, QtCore, QtWidgets, QtSerialPort
-from PyQt5.QtWidgets import QTableWidget,QTableWidgetItem,QFileDialog,QStyle
-from PyQt5.QtCore import Qt
-from airrohrFlasher.utils import QuickThread
+from PyQt5.QtWidgets import QFileDialog,QStyle
+from airrohrFlasher.utils import QuickThread, DeviceProgress
+from airrohrFlasher.cache import FirmwareCache
+from airrohrFlasher.image import DeflateCache, read_segments, plan_writes, md5_digests, \
+    plan_erase
+from airrohrFlasher.flashing import write_deflated, changed_ranges, verify_segments, \
+    erase_regions, VerifyError, EraseError
+from airrohrFlasher.transfer import TransferError, transfer_session
+from airrohrFlasher.ota import OtaError, upload_field, upload_firmware, post_file
+from airrohrFlasher.models import DeviceTableModel, DeviceFilterProxyModel, \
+    LogTableModel
+from airrohrFlasher.hotplug import port_key
+from airrohrFlasher.logs import LogStore
+from airrohrFlasher.console import ConsoleBuffer, ConsoleCapture
+from airrohrFlasher.baudrate import BaudNegotiator
+from airrohrFlasher.session import SessionManager
+from airrohrFlasher.backup import BackupStore, backup_regions, chunk_ranges, \
+    read_partition_table, config_partitions, detect_flash_size, read_mac, \
+    BOOT_REGION
 from airrohrFlasher.workers import PortDetectThread, FirmwareListThread, \
     ZeroconfDiscoveryThread, LogListenerThread
 
 from gui import mainwindow
 
 from airrohrFlasher.consts import UPDATE_REPOSITORY, UPDATE_SUPPORTFILES, ALLOWED_PROTO, \
-    PREFERED_PORTS, ROLE_DEVICE, DRIVERS_URL, DATA_ADDR,DATA_INFO, DATA_NAME, TYP_REMOTE, TYP_USB, TYP_UNKNOWN
+    PREFERED_PORTS, ROLE_DEVICE, DRIVERS_URL, DATA_ADDR,DATA_INFO, DATA_NAME, TYP_REMOTE, TYP_USB, TYP_UNKNOWN, \
+    DATA_ONLINE, CACHE_DIR, CACHE_MAX_SIZE, DEFLATE_CACHE_SIZE, DELTA_REGION_SIZE, ERASED_SKIP_SIZE, \
+    OTA_WORKERS, OTA_RETRIES, LOG_CAPACITY, LOG_REFRESH_INTERVAL, LOG_DIR, \
+    LOG_SEGMENT_SIZE, LOG_STORE_MAX_SIZE, SERIAL_BAUDRATES, SERIAL_DEFAULT_BAUDRATE, \
+    SERIAL_SCROLLBACK, SERIAL_REFRESH_INTERVAL, FLASH_BAUDRATES, BAUDRATE_CACHE, \
+    FLASH_BASELINE_BAUDRATE, SESSION_IDLE_TIMEOUT, BACKUP_DIR, BACKUP_CHUNK_SIZE, BACKUP_RETRIES
 
 if getattr(sys, 'frozen', False):
     RESOURCES_PATH = sys._MEIPASS
@@ -43,7 +60,11 @@ else:
 
 class MainWindow(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
     uploadProgress = QtCore.Signal([str, int])
+    deviceProgress = QtCore.Signal([str, str, int])
     errorSignal = QtCore.Signal([str])
+    logSearchDone = QtCore.Signal([list])
+    backupStored = QtCore.Signal([str, dict])
+    restoreMismatch = QtCore.Signal([str, str, str])
     uploadThread = None
     zeroconf_discovery = None
     boards_detected = False
@@ -65,14 +86,47 @@ class MainWindow(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
 
         self.statusbar.showMessage(self.tr("Loading firmware list..."))
 
+        self.cache = FirmwareCache(CACHE_DIR, CACHE_MAX_SIZE)
+        self.deflate_cache = DeflateCache(DEFLATE_CACHE_SIZE)
+        self.baudrates = BaudNegotiator(BAUDRATE_CACHE, FLASH_BAUDRATES,
+                                        ESPLoader.ESP_ROM_BAUD,
+                                        FLASH_BASELINE_BAUDRATE)
+        self.sessions = SessionManager(
+            lambda device, progress: self.espconnect(progress, device),
+            SESSION_IDLE_TIMEOUT)
+
         self.versionBox.clear()
-        self.firmware_list = FirmwareListThread()
+        self.version_items = {}
+        self.backup_macs = {}
+        self.backups = BackupStore(BACKUP_DIR)
+        for fname, info in self.backups.entries():
+            self.add_backup_item(fname, info)
+        self.restoreBox.setCurrentIndex(-1)
+        self.backupStored.connect(self.add_backup_item)
+        self.restoreMismatch.connect(self.on_restore_mismatch)
+        self.firmware_list = FirmwareListThread(args=[self.cache])
         self.firmware_list.listLoaded.connect(self.populate_versions)
         self.firmware_list.error.connect(self.on_work_error)
         self.firmware_list.start()
 
         self.enableDiscoveryButton(False)
 
+        self.devices = DeviceTableModel(self)
+        self.device_filter = DeviceFilterProxyModel(self)
+        self.device_filter.setSourceModel(self.devices)
+        self.discoveryList.setModel(self.device_filter)
+        self.discoveryList.sortByColumn(1, QtCore.Qt.AscendingOrder)
+        self.discoveryList.setSizeAdjustPolicy(QtWidgets.QAbstractScrollArea.AdjustToContents)
+        header = self.discoveryList.horizontalHeader()
+        header.setSectionResizeMode(0, QtWidgets.QHeaderView.ResizeToContents)
+        header.setSectionResizeMode(1, QtWidgets.QHeaderView.ResizeToContents)
+        header.setSectionResizeMode(2, QtWidgets.QHeaderView.ResizeToContents)
+        header.setSectionResizeMode(3, QtWidgets.QHeaderView.Stretch)
+        self.discoveryList.selectionModel().selectionChanged.connect(
+            self.on_discovery_selection_changed)
+        self.discoveryFilterText.textChanged.connect(self.device_filter.set_text)
+        self.discoveryOnlineCheck.toggled.connect(self.device_filter.set_online_only)
+
         self.port_detect = PortDetectThread()
         self.port_detect.portsUpdate.connect(self.populate_boards)
         self.port_detect.error.connect(self.on_work_error)
@@ -84,24 +138,76 @@ class MainWindow(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
 
 
         self.uploadProgress.connect(self.on_work_update)
+        self.deviceProgress.connect(self.on_device_update)
         self.errorSignal.connect(self.on_work_error)
-        self.cachedir = tempfile.TemporaryDirectory()
         self.serial = None
+        self.serial_capture = None
+        # Roughly SERIAL_SCROLLBACK lines of verbose debug output
+        self.serial_buffer = ConsoleBuffer(SERIAL_SCROLLBACK * 200)
+        self.serialTextEdit.setMaximumBlockCount(SERIAL_SCROLLBACK)
+        self.serialBaudBox.setValidator(QtGui.QIntValidator(300, 12000000, self))
+        for baudrate in SERIAL_BAUDRATES:
+            self.serialBaudBox.addItem(str(baudrate))
+        self.serialBaudBox.setCurrentText(str(SERIAL_DEFAULT_BAUDRATE))
+        self.serial_timer = QtCore.QTimer(self)
+        self.serial_timer.timeout.connect(self.on_serial_timer)
+
+
+        # Sizing columns to their contents would measure every row
+        self.log_model = LogTableModel(LOG_CAPACITY, self)
+        self.logTable.setModel(self.log_model)
+        header = self.logTable.horizontalHeader()
+        header.setSectionResizeMode(4, QtWidgets.QHeaderView.Stretch)
+        header.resizeSection(0, 70)
+        header.resizeSection(1, 110)
+        header.resizeSection(2, 60)
+        header.resizeSection(3, 80)
+        self.logTable.verticalHeader().setSectionResizeMode(
+            QtWidgets.QHeaderView.Fixed)
 
-
-        self.logTable.setHorizontalHeaderLabels(['Zeit', 'IP', 'Message'])
-        header = self.logTable.horizontalHeader()       
-        header.setSectionResizeMode(2, QtWidgets.QHeaderView.Stretch)
-        header.setSectionResizeMode(0, QtWidgets.QHeaderView.ResizeToContents)
-        header.setSectionResizeMode(1, QtWidgets.QHeaderView.ResizeToContents)
-
-        self.logger = LogListenerThread()
-        self.logger.logReceived.connect(self.on_logmessage_received)
+        try:
+            self.log_store = LogStore(LOG_DIR, LOG_SEGMENT_SIZE,
+                                      LOG_STORE_MAX_SIZE)
+        except OSError as exc:
+            logging.warning('Log lines are not stored: %s', exc)
+            self.log_store = None
+        self.log_results = LogTableModel(LOG_CAPACITY, self)
+        self.logSearchDone.connect(self.on_log_search_done)
+        self.logSearchButton.setEnabled(self.log_store is not None)
+        self.logExportButton.setEnabled(self.log_store is not None)
+
+        self.logger = LogListenerThread(args=[self.log_store])
+        self.logRateSpin.setValue(self.logger.ingest.rate)
+        self.logSeverityBox.currentIndexChanged.connect(self.on_log_filter_changed)
+        self.logMuteText.editingFinished.connect(self.on_log_filter_changed)
+        self.logRateSpin.valueChanged.connect(self.on_log_filter_changed)
+        self.log_drops = None
         self.logger.start()
+        self.log_timer = QtCore.QTimer(self)
+        self.log_timer.timeout.connect(self.on_log_timer)
+        self.log_timer.start(LOG_REFRESH_INTERVAL)
 
         self.addIcon(self.fileopenButton, "SP_FileDialogStart")
         self.addIcon(self.discoveryRefreshButton, "SP_BrowserReload")
 
+    def closeEvent(self, event):
+        busy = self.sessions.busy_devices()
+        if busy and QtWidgets.QMessageBox.question(
+                self, self.tr('Work in progress'), self.tr(
+                    'Still working on {devices}. Quit anyway?').format(
+                        devices=', '.join(busy))) != \
+                QtWidgets.QMessageBox.Yes:
+            event.ignore()
+            return
+
+        # Start the firmware on boards still running the flasher stub. This
+        # happens in the background, boards still busy are reset once their
+        # job is done.
+        self.sessions.close_all(wait=False)
+        if self.log_store is not None:
+            self.log_store.close()
+        super(MainWindow, self).closeEvent(event)
+
     def addIcon(self, widget, iconname):
         widget.setIcon(self.style().standardIcon(getattr(QStyle, iconname)))        
 
@@ -117,6 +223,11 @@ class MainWindow(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
     def on_work_error(self, message):
         self.statusbar.showMessage(message)
 
+    def on_device_update(self, device, status, progress):
+        """Shows progress of a single board (station mode) in the
+        discovery list"""
+        self.devices.set_status(device, '{}% {}'.format(progress, status))
+
     @property
     def version(self):
         return airrohrFlasher.__version__
@@ -151,22 +262,91 @@ class MainWindow(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
             build_id=self.build_id))
 
     def populate_versions(self, files):
-        """Loads available firmware versions into versionbox widget"""
+        """Loads available firmware versions into versionbox widget. Only
+        the differences to the versions already shown are applied."""
+
+        model = self.versionBox.model()
+        urls = set(fname[2] for fname in files)
+        for url in list(self.version_items):
+            if url not in urls:
+                model.removeRow(self.version_items.pop(url).row())
 
         for fname in files:
-            item = QtGui.QStandardItem(fname[0] + " (" + fname[1] + ")");
+            text = fname[0] + " (" + fname[1] + ")"
+            item = self.version_items.get(fname[2])
+            if item:
+                if item.text() != text:
+                    item.setText(text)
+                continue
+            item = QtGui.QStandardItem(text)
             item.setData(fname[2], ROLE_DEVICE)
-            self.versionBox.model().appendRow(item)
+            item.setData(fname[0], DATA_NAME)
+            model.appendRow(item)
+            self.version_items[fname[2]] = item
+
+        boards = sorted(set(fname[0] for fname in files))
+        board = self.selected_board()
+        self.boardBox.blockSignals(True)
+        self.boardBox.clear()
+        self.boardBox.addItem(self.tr('All boards'))
+        self.boardBox.addItems(boards)
+        if board in boards:
+            self.boardBox.setCurrentIndex(boards.index(board) + 1)
+        self.boardBox.blockSignals(False)
+        self.filter_versions()
 
         self.statusbar.clearMessage()
 
-    def populate_boards(self, ports):
-        """Populates board selection combobox from list of pyserial
-        ListPortInfo objects"""
-
-        #self.boardBox.clear()
-
-        prefered, others = self.group_ports(ports)
+    def add_backup_item(self, fname, info):
+        """Offers a backup image in restoreBox, so it can be flashed back.
+        Backups are kept apart from the firmware list, as they carry the
+        configuration of the board they were taken from."""
+        text = self.tr('Backup: {mac} {time} ({regions})').format(
+            mac=info.get('mac', '?'),
+            time=datetime.fromtimestamp(info['time']).strftime(
+                '%Y-%m-%d %H:%M'),
+            regions=', '.join(info.get('partitions') or
+                              [self.tr('full flash')]))
+        self.backup_macs[fname] = info.get('mac')
+        index = self.restoreBox.findData(fname)
+        if index >= 0:
+            self.restoreBox.setItemText(index, text)
+        else:
+            self.restoreBox.addItem(text, fname)
+
+    def selected_board(self):
+        if self.boardBox.currentIndex() > 0:
+            return self.boardBox.currentText()
+        return None
+
+    def filter_versions(self):
+        """Hides versions of other boards than the one chosen in boardBox.
+        Local files are always shown."""
+        board = self.selected_board()
+        model = self.versionBox.model()
+        view = self.versionBox.view()
+        for row in range(model.rowCount()):
+            item_board = model.item(row).data(DATA_NAME)
+            view.setRowHidden(row, bool(board and item_board and
+                                        item_board != board))
+
+        if view.isRowHidden(self.versionBox.currentIndex()):
+            for row in range(model.rowCount()):
+                if not view.isRowHidden(row):
+                    self.versionBox.setCurrentIndex(row)
+                    break
+
+    @QtCore.Slot(int)
+    def on_boardBox_currentIndexChanged(self, index):
+        self.filter_versions()
+
+    def populate_boards(self, added, removed):
+        """Updates the USB devices of the discovery list from lists of added
+        and removed pyserial ListPortInfo objects"""
+        for b in removed:
+            self.devices.set_online(port_key(b), False)
+
+        prefered, others = self.group_ports(added)
         for b in others:
             try:
                 self.statusbar.showMessage("Not Supported: %s:%s %s" %(hex(b.vid), hex(b.pid), str(b)) )
@@ -174,41 +354,22 @@ class MainWindow(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
             except Exception:
                 print("Filtered: " + str(b))
                 pass
-                
+
         for b in prefered:
             print("Found: " + str(b))
-            rowPosition = self.discoveryList.rowCount()
-            self.discoveryList.insertRow(rowPosition)
-            data = QTableWidgetItem(b.device)
-            data.setData(ROLE_DEVICE, TYP_USB)
-            data.setData(DATA_ADDR, b.device)
-            data.setData(DATA_NAME, b.description)
-            data.setData(DATA_INFO, "")
-            self.discoveryList.setItem(rowPosition , 0, data)
-            self.discoveryList.setItem(rowPosition , 1, QTableWidgetItem(b.description))
-            self.discoveryList.setItem(rowPosition , 2, QTableWidgetItem(""))
+            self.devices.upsert(port_key(b), TYP_USB, b.device,
+                                b.description, b.description)
 
-            # No prefered boards has been found so far and there is a
-            # suggested driver download URL available
-            if not self.boards_detected and DRIVERS_URL:
-                self.show_global_message(
-                    self.tr('No boards found'),
-                    self.tr('Have you installed <a href="{drivers_url}">'
-                            'the drivers</a>?').format(drivers_url=DRIVERS_URL))
-        else:
+        if self.devices.any_online(TYP_USB):
             self.globalMessage.hide()
             self.boards_detected = True
-
-        # if others:
-        #     sep = QtGui.QStandardItem(self.tr('Others...'))
-        #     sep.setEnabled(False)
-        #     self.boardBox.model().appendRow(sep)
-
-        # for b in others:
-        #     item = QtGui.QStandardItem(
-        #         '{0.description} ({0.device})'.format(b))
-        #     item.setData(b.device, ROLE_DEVICE)
-        #     self.boardBox.model().appendRow(item)
+        elif not self.boards_detected and DRIVERS_URL:
+            # No prefered boards has been found so far and there is a
+            # suggested driver download URL available
+            self.show_global_message(
+                self.tr('No boards found'),
+                self.tr('Have you installed <a href="{drivers_url}">'
+                        'the drivers</a>?').format(drivers_url=DRIVERS_URL))
 
     def group_ports(self, ports):
         prefered = []
@@ -237,126 +398,167 @@ class MainWindow(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
     @QtCore.Slot(bool)
     def on_serialConnectButton_clicked(self,checked):
         if not checked:
-            if self.serial:
-                self.serial.close()
-                self.statusbar.showMessage(self.tr("Disconnected."))
-                return
+            self.serial_close()
+            self.statusbar.showMessage(self.tr("Disconnected."))
+            return
 
         data = self.discoveryList.selectionModel().selectedRows()[0]
         device = data.data(DATA_ADDR)
-        self.serialTextEdit.setText("")
+        self.serialTextEdit.clear()
+        self.serial_buffer.take()
         if not device:
             self.statusbar.showMessage(self.tr("No device selected."))
+            self.serialConnectButton.setChecked(False)
+            return
+        if not self.release_port(device):
+            self.serialConnectButton.setChecked(False)
             return
 
-        self.serial = QtSerialPort.QSerialPort(device,
-            baudRate=QtSerialPort.QSerialPort.Baud115200,
-            readyRead=self.receive
-        )        
-        if self.serial.open(QtCore.QIODevice.ReadWrite):        
+        self.serial = QtSerialPort.QSerialPort(device, self)
+        self.serial.setBaudRate(int(self.serialBaudBox.currentText() or
+                                    SERIAL_DEFAULT_BAUDRATE))
+        self.serial.readyRead.connect(self.receive)
+        self.serial.errorOccurred.connect(self.on_serial_error)
+        if self.serial.open(QtCore.QIODevice.ReadWrite):
+            self.serial_timer.start(SERIAL_REFRESH_INTERVAL)
             self.statusbar.showMessage(self.tr("Connected."))
         else:
+            self.serial = None
+            self.serialConnectButton.setChecked(False)
             self.statusbar.showMessage(self.tr("Error while opening com port."))
 
+    def serial_close(self):
+        if self.serial:
+            self.serial.close()
+            self.serial = None
+        self.serial_timer.stop()
+        self.on_serial_timer()
+        if self.serial_capture:
+            self.serial_capture.close()
+            self.serial_capture = None
+            self.serialCaptureButton.setChecked(False)
+
+    def on_serial_error(self, error):
+        if error in (QtSerialPort.QSerialPort.NoError,
+                     QtSerialPort.QSerialPort.TimeoutError):
+            return
+        if self.serial:
+            self.statusbar.showMessage(self.serial.errorString())
+        if error == QtSerialPort.QSerialPort.ResourceError:
+            # Board unplugged
+            self.serial_close()
+            self.serialConnectButton.setChecked(False)
 
     @QtCore.Slot()
     def receive(self):
-        while self.serial.canReadLine():
-            text = self.serial.readLine().data().decode()
-            text = text.rstrip('\r\n')
-            self.serialTextEdit.append(text)
+        """Only buffers the received bytes, the monitor is updated by
+        on_serial_timer"""
+        data = self.serial.readAll().data()
+        if self.serial_capture:
+            self.serial_capture.write(data)
+        self.serial_buffer.feed(data)
+
+    def on_serial_timer(self):
+        text = self.serial_buffer.take()
+        if not text:
+            return
+        scrollbar = self.serialTextEdit.verticalScrollBar()
+        follow = scrollbar.value() == scrollbar.maximum()
+        cursor = QtGui.QTextCursor(self.serialTextEdit.document())
+        cursor.movePosition(QtGui.QTextCursor.End)
+        cursor.insertText(text)
+        if follow:
+            scrollbar.setValue(scrollbar.maximum())
+
+    @QtCore.Slot(bool)
+    def on_serialCaptureButton_clicked(self, checked):
+        if self.serial_capture:
+            self.serial_capture.close()
+            self.serial_capture = None
+        if not checked:
+            return
 
+        fileName, _ = QFileDialog.getSaveFileName(
+            self, self.tr("Capture serial output"),
+            datetime.now().strftime("serial-%Y%m%d-%H%M%S.log"),
+            "Log files (*.log *.txt);;All Files (*)",
+            options=QFileDialog.DontUseNativeDialog)
+        if not fileName:
+            self.serialCaptureButton.setChecked(False)
+            return
+        try:
+            self.serial_capture = ConsoleCapture(fileName)
+        except OSError as exc:
+            self.statusbar.showMessage(str(exc))
+            self.serialCaptureButton.setChecked(False)
+
+    def release_port(self, device):
+        """Closes an idle flasher session on device, so the GUI thread can
+        open the port. Refuses while a job is running on the board, rather
+        than blocking until it is done."""
+        if self.sessions.busy(device):
+            self.statusbar.showMessage(self.tr("Work in progess..."))
+            return False
+        # Nothing is queued, this only resets the board
+        self.sessions.close(device).result()
+        return True
 
     def upload(self, device, content, size, filename):
-        with serial.Serial(device, 115200, timeout=1) as ser:
-            ser.write("xdebug".encode('utf-8'))
-            s = ser.readline().decode('utf-8').rstrip('\r\n')
-            print("From ESP>" + s)
-            if (s != "Debugmodus aktiviert"):                
-                s = ser.readline().decode('utf-8').rstrip('\r\n')
-                print("From ESP>" + s)
-            if (s != "Debugmodus aktiviert"):               
-                self.statusbar.showMessage(self.tr("Aktivierung des Debugmodus fehlgeschlagen!"))
-                return False
-            ser.write("_".encode('utf-8'))
-            s = ser.readline().decode('utf-8').rstrip('\r\n')
-            print("From ESP>" + s)
-            if (s != "TRANSFER ACTIVE"):               
-                self.statusbar.showMessage(self.tr("Aktivierung des Transfers fehlgeschlagen!"))
-                return False
-            b64 = base64.b64encode(content)
-            s = "PUT " + str(len(b64)) + " " + filename + "\r\n"
-            ser.write(s.encode('iso-8859-1'))
-            # print(b64)
-            print(s)
-            print("Len " + str(len(b64)))
-            currentSegment = 0
-            finish = False
-            while not finish:
-                print(filename + " Sending: " + str(currentSegment) + " => " + str(b64[currentSegment:500 + currentSegment]))
-                ser.write(b64[currentSegment:500 + currentSegment])
-                ser.flush()
-                err = 0
-                while not finish:
-                  s = ser.readline().decode('utf-8').rstrip('\r\n')
-                  print("3: " + s)
-                  if (s == ""):
-                      err = err + 1
-                  if (err > 5):
-                      self.statusbar.showMessage(self.tr("ESP antwortet nicht"))
-                      return
-                  if (s.startswith("SEGMENT OK ")):
-                      currentSegment += 500
-                      self.statusbar.showMessage(filename + " " + self.tr("Sending: " + str(currentSegment)))
-                      break
-                  if (s.startswith("SEGMENT FAIL ")):
-                     self.statusbar.showMessage(self.tr("Resending"))
-                     break
-                  if (s.startswith("TRANSFER END")):
-                      finish = True
-                      self.statusbar.showMessage(self.tr("Transfer fertig!"))
-                      break
-            ser.write("x".encode('utf-8'))
-            s = ser.readline().decode('utf-8').rstrip('\r\n')
-            return True
+        def report(sent, total):
+            self.statusbar.showMessage(filename + " " + self.tr(
+                "Sending: {sent}/{total}").format(sent=sent, total=total))
+
+        if not self.release_port(device):
+            return False
+        try:
+            with transfer_session(device) as transfer:
+                transfer.put(filename, content, report)
+        except TransferError as exc:
+            self.statusbar.showMessage(str(exc))
+            return False
+        self.statusbar.showMessage(self.tr("Transfer fertig!"))
+        return True
 
     @QuickThread.wrap
     def uploadFilesRemote(self, progress, ip, files):
         idx = 0
         count = len(files)
-        steps = int(100.0/count/2.0)
-        status = 0
-        for x in files:
-            fname = os.path.basename(x)            
-
-            progress.emit(self.tr('Downloading {filename} ({idx}/{count}) ...').format(filename=fname, idx=idx, count=count), status)
-            u = requests.get(url=x)
-            if (u.status_code != 200):
-                self.uploadProgress.emit(self.tr('Download fehlgeschlagen!'), 0)
-            status = status + steps
-
-            progress.emit(self.tr('Uploading {filename} ({idx}/{count}) ...').format(filename=fname, idx=idx, count=count), status)
-            r = requests.post("http://" + ip + "/upload", files={fname: u.content})
-            print(u.status_code)
-            status = status + steps
-            idx = idx + 1
+        session = requests.Session()
+        progress.emit(self.tr('Downloading {count} files ...').format(count=count), 0)
+        try:
+            # Files are downloaded concurrently and uploaded as they arrive
+            for x, path in self.cache.prefetch(files):
+                fname = os.path.basename(x)
+
+                progress.emit(self.tr('Uploading {filename} ({idx}/{count}) ...').format(filename=fname, idx=idx, count=count), 100 * idx // count)
+                with open(path, 'rb') as fd:
+                    r = session.post("http://" + ip + "/upload", files={fname: fd})
+                if (r.status_code != 200):
+                    progress.emit(self.tr('Upload fehlgeschlagen'), 100 * idx // count)
+                    return
+                idx = idx + 1
+        except requests.RequestException:
+            progress.emit(self.tr('Download fehlgeschlagen!'), 0)
+            return
         progress.emit(self.tr('Finish'), 100)
 
 
 
+    def support_files(self):
+        """Returns the support file URLs listed in supportfiles.json"""
+        with open(self.cache.fetch(UPDATE_SUPPORTFILES, timeout=10)) as fd:
+            return json.load(fd)["files"]
+
     @QtCore.Slot()
     def on_uploadSupportRemote_clicked(self):
         try:
-            r = requests.get(url=UPDATE_SUPPORTFILES)
-            print(r.text)
-            json = r.json()
-            idx = 0
+            files = self.support_files()
             data = self.discoveryList.selectionModel().selectedRows()[0]
             ip = data.data(DATA_ADDR) 
             if self.uploadFilesRemote.running():
                 self.statusbar.showMessage(self.tr("Work in progess..."))
                 return
-            self.uploadFilesRemote(self.uploadProgress, ip, json["files"])
+            self.uploadFilesRemote(self.uploadProgress, ip, files)
 
         except Exception as e:
             self.uploadProgress.emit(self.tr('Fehler: ' + str(e)) , 100)
@@ -370,37 +572,50 @@ class MainWindow(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
         if fileName:
             data = self.discoveryList.selectionModel().selectedRows()[0]
             ip = data.data(DATA_ADDR) 
-            print(ip)
-            self.uploadProgress.emit(self.tr('Uploading to ') + ip , 0)
-            #
-            # files = {'Datei': open('report.xls', 'rb')}
-            with open(fileName, 'rb') as f:
-                r = requests.post("http://" + ip + "/upload", files={'datei': f})
-                print(r.text)
-                print(r.status_code)
-                if (r.status_code == 200):
-                    self.uploadProgress.emit(self.tr('Finish ') + fileName , 100)
-                else:
-                    self.uploadProgress.emit(self.tr('Upload fehlgeschlagen') , 0)
+            if self.uploadFileRemote.running():
+                self.statusbar.showMessage(self.tr("Work in progess..."))
+                return
+            self.uploadFileRemote(self.uploadProgress, ip, fileName)
+
+    @QuickThread.wrap
+    def uploadFileRemote(self, progress, ip, fileName):
+        progress.emit(self.tr('Uploading to ') + ip , 0)
+        try:
+            r = post_file("http://" + ip + "/upload", 'datei',
+                          os.path.basename(fileName), fileName,
+                          self.upload_reporter(progress))
+        except (requests.RequestException, OSError) as exc:
+            progress.emit(self.tr('Upload fehlgeschlagen: {error}').format(
+                          error=exc), 0)
+            return
+        if (r.status_code == 200):
+            progress.emit(self.tr('Finish ') + fileName , 100)
+        else:
+            progress.emit(self.tr('Upload fehlgeschlagen') , 0)
 
     @QuickThread.wrap
     def uploadFilesUSB(self, progress, device, files):
         idx = 0
         count = len(files)
-        steps = int(100.0/count/2.0)
-        status = 0
-        for x in files:
-            fname = os.path.basename(x)            
-
-            progress.emit(self.tr('Downloading {filename} ({idx}/{count}) ...').format(filename=fname, idx=idx, count=count), status)
-            u = requests.get(url=x)
-            status = status + steps
-
-            progress.emit(self.tr('Uploading {filename} ({idx}/{count}) ...').format(filename=fname, idx=idx, count=count), status)
-            if not self.upload(device, u.content, len(u.content), fname):
-                return
-            status = status + steps
-            idx = idx + 1
+        progress.emit(self.tr('Downloading {count} files ...').format(count=count), 0)
+        try:
+            # Transfer mode is entered only once for all files, which are
+            # downloaded concurrently and uploaded as they arrive
+            self.sessions.close(device).result()
+            with transfer_session(device) as transfer:
+                for x, path in self.cache.prefetch(files):
+                    fname = os.path.basename(x)
+
+                    progress.emit(self.tr('Uploading {filename} ({idx}/{count}) ...').format(filename=fname, idx=idx, count=count), 100 * idx // count)
+                    with open(path, 'rb') as fd:
+                        transfer.put(fname, fd.read())
+                    idx = idx + 1
+        except TransferError as exc:
+            progress.emit(str(exc), 100 * idx // count)
+            return
+        except requests.RequestException:
+            progress.emit(self.tr('Download fehlgeschlagen!'), 0)
+            return
         progress.emit(self.tr('Finish'), 100)
 
 
@@ -408,13 +623,11 @@ class MainWindow(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
     def on_uploadSupportFiles_clicked(self):
         data = self.discoveryList.selectionModel().selectedRows()[0]
         device = data.data(DATA_ADDR)
-        r = requests.get(url=UPDATE_SUPPORTFILES)
-        print(r.text)
-        json = r.json()
+        files = self.support_files()
         if self.uploadFilesUSB.running():
                 self.statusbar.showMessage(self.tr("Work in progess..."))
                 return
-        self.uploadFilesUSB(self.uploadProgress, device, json["files"])
+        self.uploadFilesUSB(self.uploadProgress, device, files)
 
     @QtCore.Slot()
     def on_uploadConfigFile_clicked(self):
@@ -431,230 +644,560 @@ class MainWindow(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
                     self.upload(device, content, size, "config.json")
 
 
+    def selected_firmware(self):
+        """Returns the firmware URI/path chosen in versionBox or None when
+        the input is invalid"""
+        version = self.versionBox.currentText()
+
+        if not version:
+            self.statusbar.showMessage(self.tr("No version selected."))
+            return None
+
+        sel = self.versionBox.model().item(
+            self.versionBox.currentIndex())
+        if sel:
+            orig_version = sel.text()
+        else:
+            orig_version = ''
+
+        if version == orig_version:
+            # Editable combobox has been unchanged
+            return self.versionBox.currentData(ROLE_DEVICE)
+        elif version.startswith(ALLOWED_PROTO):
+            # User has provided a download URL
+            return version
+        elif os.path.exists(version):
+            return version
+
+        self.statusbar.showMessage(self.tr(
+            "Invalid version / file does not exist"))
+        return None
+
     @QtCore.Slot()
     def on_flashButton_clicked(self):
         self.statusbar.clearMessage()
 
-        data = self.discoveryList.selectionModel().selectedRows()[0]
+        rows = self.discoveryList.selectionModel().selectedRows()
+        data = rows[0]
         typ = data.data(ROLE_DEVICE)
         if (typ == TYP_USB):
             device = data.data(DATA_ADDR)
-            version = self.versionBox.currentText()
 
             if not device:
                 self.statusbar.showMessage(self.tr("No device selected."))
                 return
 
-            if not version:
-                self.statusbar.showMessage(self.tr("No version selected."))
+            binary_uri = self.selected_firmware()
+            if not binary_uri:
                 return
 
-            sel = self.versionBox.model().item(
-                self.versionBox.currentIndex())
-            if sel:
-                orig_version = sel.text()
-            else:
-                orig_version = ''
-
-            if version == orig_version:
-                # Editable combobox has been unchanged
-                binary_uri = self.versionBox.currentData(ROLE_DEVICE)
-            elif version.startswith(ALLOWED_PROTO):
-                # User has provided a download URL
-                binary_uri = version
-            elif os.path.exists(version):
-                binary_uri = version
-            else:
-                self.statusbar.showMessage(self.tr(
-                    "Invalid version / file does not exist"))
+            if self.flash_board.running() or self.flash_station.running():
+                self.statusbar.showMessage(self.tr("Work in progess..."))
                 return
 
-            if self.flash_board.running():
-                self.statusbar.showMessage(self.tr("Work in progess..."))
+            delta = self.deltaFlashCheck.isChecked()
+            verify = self.verifyCheck.isChecked()
+            if self.stationModeCheck.isChecked():
+                devices = [r.data(DATA_ADDR) for r in rows
+                           if r.data(ROLE_DEVICE) == TYP_USB and
+                           r.data(DATA_ONLINE)]
+                self.flash_station(self.uploadProgress, devices, binary_uri,
+                                   delta=delta, verify=verify,
+                                   error=self.errorSignal)
+                return
+
+            if not data.data(DATA_ONLINE):
+                self.statusbar.showMessage(self.tr("Device is offline."))
                 return
 
             self.flash_board(self.uploadProgress, device, binary_uri,
-                            error=self.errorSignal)
+                             delta=delta, verify=verify,
+                             error=self.errorSignal)
 
         if (typ == TYP_REMOTE):
-            try:
-                progress = self.uploadProgress
-                version = self.versionBox.currentText()
-                sel = self.versionBox.model().item(
-                    self.versionBox.currentIndex())
-                if sel:
-                    orig_version = sel.text()
-                else:
-                    orig_version = ''
-
-                if version == orig_version:
-                    # Editable combobox has been unchanged
-                    binary_uri = self.versionBox.currentData(ROLE_DEVICE)
-                elif version.startswith(ALLOWED_PROTO):
-                    # User has provided a download URL
-                    binary_uri = version
-                elif os.path.exists(version):
-                    binary_uri = version
-                else:
-                    self.statusbar.showMessage(self.tr("Invalid version / file does not exist"))
-                    return
-            
-                if binary_uri.startswith(ALLOWED_PROTO):
-                    binary_uri = self.cache_download(progress, binary_uri)
-
-                QtWidgets.QApplication.setOverrideCursor(Qt.WaitCursor)
-                info = data.data(DATA_INFO)
+            devices = [(r.data(DATA_ADDR), r.data(DATA_INFO)) for r in rows
+                       if r.data(ROLE_DEVICE) == TYP_REMOTE and
+                       r.data(DATA_ONLINE)]
+            if not devices:
+                self.statusbar.showMessage(
+                    self.tr("No online device selected."))
+                return
 
-                flashModus = ""
-                if b'FlashModus' in info.properties:
-                    flashModus =  info.properties.get(b'FlashModus')
+            binary_uri = self.selected_firmware()
+            if not binary_uri:
+                return
 
+            if self.flash_remote.running():
+                self.statusbar.showMessage(self.tr("Work in progess..."))
+                return
 
-                url = "http://"  + data.data(DATA_ADDR) + "/firmware" 
-                auth=HTTPBasicAuth('admin', 'admin')
-                if (flashModus == "Arduino_Esp8266_2.6"):
-                    files = {'firmware': open(binary_uri,'rb')}
-                elif (flashModus == "Arduino_Esp8266_2.5" or flashModus == ""):
-                    files = {'file': open(binary_uri,'rb')}
+            self.flash_remote(self.uploadProgress, devices, binary_uri,
+                              error=self.errorSignal)
 
-                values = {}
-                progress.emit(self.tr('Uploading...'), 1)
-                r = requests.post(url, files=files, data=values,auth=auth)
-                if (r.status_code == 200):
-                    string = re.sub('<.*?>', '', r.text)
-                    progress.emit(self.tr("Finish. {text}").format(text=string), 100)
-                else:
-                    progress.emit(self.tr('Error {code} : {text}').format(code = str(r.status_code), text = r.text), 1)
-            finally:
-                QtWidgets.QApplication.restoreOverrideCursor() 
+    @QuickThread.wrap
+    def flash_remote(self, progress, devices, binary_uri):
+        """Updates the firmware of all given (address, info) network devices,
+        at most OTA_WORKERS at a time. The image is read once and streamed
+        from that shared copy by all uploads."""
+        if binary_uri.startswith(ALLOWED_PROTO):
+            binary_uri = self.cache_download(progress, binary_uri)
 
+        with open(binary_uri, 'rb') as fd:
+            image = fd.read()
+
+        progress.emit(self.tr('Updating {count} devices...').format(
+                      count=len(devices)), 0)
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=OTA_WORKERS) as pool:
+            jobs = {pool.submit(self.ota_device,
+                                DeviceProgress(self.deviceProgress, address),
+                                address, info, image): address
+                    for address, info in devices}
+
+            updated = 0
+            for job in concurrent.futures.as_completed(jobs):
+                address = jobs[job]
+                try:
+                    job.result()
+                    updated += 1
+                except Exception as exc:
+                    logging.exception('Updating %s failed', address)
+                    self.deviceProgress.emit(address, self.tr(
+                        'Failed: {error}').format(error=exc), 0)
+                progress.emit(self.tr(
+                    'Updated {updated}/{count} devices').format(
+                        updated=updated, count=len(devices)),
+                    100 * updated // len(devices))
+
+    def upload_reporter(self, progress):
+        """Returns a MultipartEncoder progress callback reporting bytes sent
+        and throughput through progress"""
+        def report(sent, total, rate):
+            progress.emit(self.tr(
+                'Uploading... {sent} of {total} kB ({rate:.1f} kB/s)').format(
+                    sent=sent // 1024, total=total // 1024, rate=rate / 1024),
+                max(1, 100 * sent // total))
+        return report
+
+    def ota_device(self, progress, address, info, image, retries=OTA_RETRIES):
+        """Uploads image to a single network device, retrying failed
+        uploads with increasing delays"""
+        field = upload_field(info)
+        report = self.upload_reporter(progress)
+        for attempt in range(retries + 1):
+            progress.emit(self.tr('Uploading...'), 1)
+            try:
+                text = upload_firmware(address, image, field, report)
+            except (OtaError, requests.RequestException) as exc:
+                if attempt == retries:
+                    raise
+                progress.emit(self.tr('Retrying: {error}').format(
+                              error=exc), 1)
+                time.sleep(2 ** attempt)
+            else:
+                progress.emit(self.tr("Finish. {text}").format(text=text), 100)
+                return
 
     def cache_download(self, progress, binary_uri):
         """Downloads and caches file with status reports via Qt Signals"""
-        cache_fname = os.path.join(
-            self.cachedir.name,
-            hashlib.sha256(binary_uri.encode('utf-8')).hexdigest())
-
-        if os.path.exists(cache_fname):
-            return cache_fname
-
-        with open(cache_fname, 'wb') as fd:
-            progress.emit(self.tr('Downloading...'), 0)
-            response = requests.get(binary_uri, stream=True)
-            total_length = response.headers.get('content-length')
+        def report(done, total):
+            if total:
+                progress.emit(self.tr('Downloading...'), (100*done) // total)
 
-            dl = 0
-            total_length = int(total_length or 0)
-            for data in response.iter_content(chunk_size=4096):
-                dl += len(data)
-                fd.write(data)
+        progress.emit(self.tr('Checking cached download...'), 0)
+        return self.cache.fetch(binary_uri, report)
 
-                if total_length:
-                    progress.emit(self.tr('Downloading...'),
-                                  (100*dl) // total_length)
+    @QuickThread.wrap
+    def erase_board(self, progress, device, binary_uri=None, full=False,
+                    keep_config=False):
+        """Erases the regions of the image binary_uri, the whole flash
+        (full) or otherwise all partitions of the board. With keep_config
+        the configuration and file system partitions are left alone."""
+        regions = None
+        if binary_uri:
+            if binary_uri.startswith(ALLOWED_PROTO):
+                binary_uri = self.cache_download(progress, binary_uri)
+            regions = [(address, len(data))
+                       for address, data in read_segments(binary_uri)]
 
-        return cache_fname
+        t = time.time()
+        erased = self.sessions.run(device, functools.partial(
+            self.erase_planned, progress, regions, full, keep_config),
+            progress)
+        progress.emit(self.tr(
+            'Erased {size} kB in {time:.2f} seconds.').format(
+                size=erased // 1024, time=time.time() - t), 100)
+
+    def erase_planned(self, progress, regions, full, keep_config, esp):
+        """Session job erasing (address, length) regions, the whole flash
+        (full) or, when regions is None, bootloader, partition table and all
+        partitions, and returning the number of bytes erased. Without anything to keep, the whole flash
+        and boards without partition table are erased with a chip erase."""
+        partitions = read_partition_table(esp)
+        keep = []
+        if keep_config:
+            if not partitions:
+                raise EraseError(self.tr(
+                    'No partition table, cannot keep the configuration'))
+            keep = [(p.address, p.size) for p in config_partitions(partitions)]
+
+        if regions is None and not full and partitions:
+            regions = [BOOT_REGION] + [(p.address, p.size)
+                                       for p in partitions]
+
+        size = detect_flash_size(esp)
+        if not regions:
+            if not keep:
+                progress.emit(self.tr('Erasing whole flash...'), 0)
+                esp.erase_flash()
+                return size or 0
+            if size is None:
+                raise EraseError(self.tr('Unknown flash size'))
+            regions = [(0x0, size)]
+
+        steps = plan_erase(regions, keep, size)
+        total = sum(length for _, length in steps) or 1
+        done = [0]
+
+        def report(address, length, skipped):
+            if skipped:
+                text = self.tr('Already erased 0x{address:08x}')
+            else:
+                text = self.tr('Erasing 0x{address:08x}...')
+            progress.emit(text.format(address=address),
+                          100 * done[0] // total)
+            done[0] += length
 
-    @QuickThread.wrap
-    def erase_board(self, progress, device, baudrate=460800):
-        progress.emit(self.tr('Connecting...'), 0)
-        init_baud = min(ESPLoader.ESP_ROM_BAUD, baudrate)
-        esp = ESPLoader.detect_chip(device, init_baud, 'default_reset', False)
-
-        progress.emit(self.tr('Connected. Chip type: {chip_type}').format(
-                      chip_type=esp.get_chip_description()), 0)
-        esp = esp.run_stub()
-        esp.change_baud(baudrate)
-        esp.erase_flash()
-        progress.emit(self.tr('Erasing complete!'), 100)
+        return erase_regions(esp, steps, report)
 
     @QtCore.Slot()
     def on_eraseButton_clicked(self):
         self.statusbar.clearMessage()
         data = self.discoveryList.selectionModel().selectedRows()[0]
         device = data.data(DATA_ADDR)
+        if not data.data(DATA_ONLINE):
+            self.statusbar.showMessage(self.tr("Device is offline."))
+            return
 
         if self.erase_board.running():
             self.statusbar.showMessage(self.tr("Erasing in progress..."))
             return
 
-        self.erase_board(self.uploadProgress, device,
+        # eraseModeBox: device partitions, regions of the chosen image,
+        # whole flash
+        mode = self.eraseModeBox.currentIndex()
+        binary_uri = None
+        if mode == 1:
+            binary_uri = self.selected_firmware()
+            if not binary_uri:
+                return
+
+        self.erase_board(self.uploadProgress, device, binary_uri,
+                         full=mode == 2,
+                         keep_config=self.keepConfigCheck.isChecked(),
                          error=self.errorSignal)
 
+    @QtCore.Slot()
+    def on_backupButton_clicked(self):
+        self.statusbar.clearMessage()
+        data = self.discoveryList.selectionModel().selectedRows()[0]
+        device = data.data(DATA_ADDR)
+        if not data.data(DATA_ONLINE):
+            self.statusbar.showMessage(self.tr("Device is offline."))
+            return
+
+        if self.backup_board.running():
+            self.statusbar.showMessage(self.tr("Backup in progress..."))
+            return
+
+        names = self.backupPartitionsText.text().replace(',', ' ').split()
+        self.backup_board(self.uploadProgress, device, names,
+                          error=self.errorSignal)
+
+    @QuickThread.wrap
+    def backup_board(self, progress, device, names):
+        """Reads the whole flash, or only the partitions called names, into
+        a backup image offered in restoreBox. Flash is read in chunks of
+        BACKUP_CHUNK_SIZE, each as a session job of its own: a failing read
+        (e.g. the USB adapter dropping off the bus) closes the session, and
+        the chunk is read again on a new connection, so the backup resumes
+        where it stopped instead of starting over."""
+        def describe(esp):
+            _, regions = backup_regions(esp, names)
+            info = {
+                'mac': read_mac(esp),
+                'chip': esp.get_chip_description(),
+                'partitions': names,
+            }
+            return regions, info
+
+        progress.emit(self.tr('Reading partition table...'), 0)
+        regions, info = self.sessions.run(device, describe, progress)
+
+        total = sum(length for _, length in regions)
+        done = 0
+        segments = []
+        t = time.time()
+        for address, length in regions:
+            data = bytearray(length)
+            for chunk, size in chunk_ranges(address, length,
+                                            BACKUP_CHUNK_SIZE):
+                for attempt in range(BACKUP_RETRIES + 1):
+                    try:
+                        data[chunk - address:chunk - address + size] = \
+                            self.sessions.run(device, functools.partial(
+                                self.read_chunk, chunk, size), progress)
+                        break
+                    except Exception as exc:
+                        if attempt == BACKUP_RETRIES:
+                            raise
+                        logging.warning('Reading 0x%08x failed: %s',
+                                        chunk, exc)
+                        progress.emit(self.tr('Retrying: {error}').format(
+                                      error=exc), 100 * done // total)
+                        time.sleep(2 ** attempt)
+
+                done += size
+                progress.emit(self.tr(
+                    'Reading 0x{address:08x}... ({rate:.1f} kB/s)').format(
+                        address=chunk + size,
+                        rate=done / (time.time() - t) / 1024),
+                    100 * done // total)
+            segments.append((address, data))
+        t = time.time() - t
+
+        self.backupStored.emit(*self.backups.add(segments, **info))
+        progress.emit(self.tr(
+            'Backup of {size} kB finished in {time:.2f} seconds.').format(
+                size=total // 1024, time=t), 100)
+
+    @staticmethod
+    def read_chunk(address, length, esp):
+        return esp.read_flash(address, length)
+
+    @QtCore.Slot()
+    def on_restoreButton_clicked(self):
+        self.statusbar.clearMessage()
+        data = self.discoveryList.selectionModel().selectedRows()[0]
+        device = data.data(DATA_ADDR)
+        if not data.data(DATA_ONLINE):
+            self.statusbar.showMessage(self.tr("Device is offline."))
+            return
+        fname = self.restoreBox.currentData()
+        if not fname:
+            self.statusbar.showMessage(self.tr("No backup selected."))
+            return
+
+        if self.restore_board.running() or self.flash_board.running():
+            self.statusbar.showMessage(self.tr("Work in progess..."))
+            return
+
+        self.restore_board(self.uploadProgress, device, fname,
+                           self.backup_macs.get(fname),
+                           error=self.errorSignal)
+
     @QuickThread.wrap
-    def flash_board(self, progress, device, binary_uri, baudrate=460800):
+    def restore_board(self, progress, device, fname, mac, force=False):
+        """Flashes a backup back and verifies it. Unless force is set, the
+        backup is only written to the board it was taken from; for any
+        other board restoreMismatch asks for confirmation first."""
+        def restore(esp):
+            board = read_mac(esp)
+            if board != mac and not force:
+                return board
+            self.flash_image(progress, fname, False, True, esp)
+            return None
+
+        board = self.sessions.run(device, restore, progress)
+        if board:
+            progress.emit(self.tr('Backup is from another board.'), 0)
+            self.restoreMismatch.emit(device, fname, board)
+
+    def on_restore_mismatch(self, device, fname, board):
+        answer = QtWidgets.QMessageBox.warning(
+            self, self.tr('Restore backup'), self.tr(
+                'The backup was taken from {mac}, but the board on {device} '
+                'is {board}. Its flash and configuration will be replaced. '
+                'Restore anyway?').format(
+                    mac=self.backup_macs.get(fname) or '?', device=device,
+                    board=board),
+            QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No,
+            QtWidgets.QMessageBox.No)
+        if answer == QtWidgets.QMessageBox.Yes:
+            self.restore_board(self.uploadProgress, device, fname,
+                               self.backup_macs.get(fname), force=True,
+                               error=self.errorSignal)
+
+    @QuickThread.wrap
+    def flash_board(self, progress, device, binary_uri, delta=False,
+                    verify=False):
         if binary_uri.startswith(ALLOWED_PROTO):
             binary_uri = self.cache_download(progress, binary_uri)
 
-        progress.emit(self.tr('Connecting...'), 0)
-
-        init_baud = min(ESPLoader.ESP_ROM_BAUD, baudrate)
-        esp = ESPLoader.detect_chip(device, init_baud, 'default_reset', False)
+        self.sessions.run(device, functools.partial(
+            self.flash_image, progress, binary_uri, delta, verify), progress)
 
-        progress.emit(self.tr('Connected. Chip type: {chip_type}').format(
-                      chip_type=esp.get_chip_description()), 0)
-        esp = esp.run_stub()
-        esp.change_baud(baudrate)
+    @QuickThread.wrap
+    def flash_station(self, progress, devices, binary_uri, delta=False,
+                      verify=False):
+        """Flashes the same image to all given ports at once. Every port has
+        its own session worker thread, as the work is bound by serial I/O."""
+        if binary_uri.startswith(ALLOWED_PROTO):
+            binary_uri = self.cache_download(progress, binary_uri)
 
+        progress.emit(self.tr('Flashing {count} boards...').format(
+                      count=len(devices)), 0)
 
         t = time.time()
-        if zipfile.is_zipfile(binary_uri):
-            with zipfile.ZipFile(binary_uri) as myzip:
-                for fname in myzip.namelist():
-                    if fname.startswith("0x"):
-                        addr = int(fname, 16)
-                        with myzip.open(fname) as myfile:
-                            data = myfile.read()
-                            print("Segment: " + fname + " / " + str(addr) + " Size: " + str(len(data)))
-                            self.flashBlock(data, progress, esp, addr)
-                    else:
-                        print("Cannot handle " + fname)
+        jobs = {}
+        for device in devices:
+            device_progress = DeviceProgress(self.deviceProgress, device)
+            jobs[self.sessions.submit(device, functools.partial(
+                self.flash_image, device_progress, binary_uri, delta, verify),
+                device_progress)] = device
+        concurrent.futures.wait(jobs)
+
+        flashed = 0
+        written = 0
+        for job, device in jobs.items():
+            try:
+                written += job.result()
+                flashed += 1
+            except Exception as exc:
+                logging.exception('Flashing %s failed', device)
+                self.deviceProgress.emit(device, self.tr(
+                    'Failed: {error}').format(error=exc), 0)
+        t = time.time() - t
+
+        progress.emit(self.tr(
+            'Flashed {flashed}/{count} boards in {time:.2f} seconds '
+            '({rate:.1f} kB/s total).').format(
+                flashed=flashed, count=len(devices), time=t,
+                rate=written / t / 1024), 100)
+
+    def flash_image(self, progress, binary_uri, delta, verify, esp):
+        """Session job flashing a local image file and returning the number
+        of bytes written. In delta mode only regions differing from the
+        current flash content are written. With verify the MD5 of every
+        segment is compared with the flash content afterwards."""
+        segments = read_segments(binary_uri)
+        if verify:
+            digests = md5_digests(segments)
 
+        t = time.time()
+        if delta:
+            written = self.flash_delta(progress, esp, segments)
         else:
-            with open(binary_uri, 'rb') as fd:
-                uncimage = fd.read()
-            self.flashBlock(uncimage, progress, esp, 0x0)
-        t = time.time() - t
+            written = self.write_regions(progress, esp, segments)
 
+        # Leave the stub running for further jobs, the board is reset when
+        # the session is closed
+        esp.flash_begin(0, 0)
+        esp.flash_defl_finish(False)
+        t = time.time() - t
 
-        esp.flash_finish(True)
+        if verify:
+            self.verify_image(progress, esp, segments, digests)
 
         progress.emit(self.tr(
             'Finished in {time:.2f} seconds.').format(
                 time=t), 100)
+        return written
+
+    def verify_image(self, progress, esp, segments, digests):
+        """Raises VerifyError unless all segments match the flash content"""
+        def report(address, length, ok, seconds):
+            logging.info('Verify 0x%08x (%d bytes): %s in %.2f s', address,
+                         length, 'ok' if ok else 'FAILED', seconds)
+            progress.emit(self.tr(
+                'Verify 0x{address:08x}: {result} ({time:.2f} s)').format(
+                    address=address, time=seconds,
+                    result=self.tr('OK') if ok else self.tr('FAILED')), 100)
+
+        progress.emit(self.tr('Verifying...'), 100)
+        failed = verify_segments(esp, segments, digests, report)
+        if failed:
+            raise VerifyError(self.tr(
+                'Verify failed at {addresses}').format(addresses=', '.join(
+                    '0x%08x' % address for address in failed)))
+
+    def flash_delta(self, progress, esp, segments):
+        """Writes only the regions of segments whose MD5 differs from the
+        flash content and returns the number of bytes written"""
+        regions = []
+        for addr, data in segments:
+            progress.emit(self.tr('Comparing 0x{address:08x}...').format(
+                          address=addr), 0)
+            ranges = changed_ranges(esp, addr, data, DELTA_REGION_SIZE)
+            print("Segment: " + hex(addr) + " Changed: " + str(ranges))
+
+            view = memoryview(data)
+            regions += [(addr + offset, view[offset:offset + length])
+                        for offset, length in ranges]
+        return self.write_regions(progress, esp, regions)
+
+    def write_regions(self, progress, esp, regions):
+        """Writes (address, data) regions and returns the number of bytes
+        they cover. Long runs of 0xFF are erased instead of written. Regions are
+        deflated in the background while earlier ones are already being
+        written."""
+        steps = []
+        for addr, data in regions:
+            view = memoryview(data)
+            steps += [(step, addr + offset, view[offset:offset + length])
+                      for step, offset, length in plan_writes(
+                          addr, data, min_skip=ERASED_SKIP_SIZE)]
+
+        writes = [(addr, data) for step, addr, data in steps
+                  if step == 'write']
+        deflated = self.deflate_cache.prepare(writes, esp.FLASH_WRITE_SIZE)
 
-    def espconnect(self, progress, device, baudrate=460800):
-        progress.emit(self.tr('Connecting...'), 0)
-
-        init_baud = min(ESPLoader.ESP_ROM_BAUD, baudrate)
-        esp = ESPLoader.detect_chip(device, init_baud, 'default_reset', False)
-
-        progress.emit(self.tr('Connected. Chip type: {chip_type}').format(
-                      chip_type=esp.get_chip_description()), 0)
-        esp = esp.run_stub()
-        esp.change_baud(baudrate)
+        written = 0
+        for step, addr, data in steps:
+            print("Segment: " + hex(addr) + " Size: " + str(len(data)) +
+                  " " + step)
+            if step == 'erase':
+                progress.emit(self.tr('Erasing 0x{address:08x}...').format(
+                              address=addr), 0)
+                esp.erase_region(addr, len(data))
+            else:
+                self.flashBlock(data, progress, esp, addr, next(deflated))
+            written += len(data)
+        return written
+
+    def espconnect(self, progress, device, baudrate=None):
+        """Connects to the board at device and starts the flasher stub.
+        Unless baudrate is given, the fastest rate the adapter handles
+        reliably is negotiated."""
+        def connect():
+            progress.emit(self.tr('Connecting...'), 0)
+            esp = ESPLoader.detect_chip(device, ESPLoader.ESP_ROM_BAUD,
+                                        'default_reset', False)
+            progress.emit(self.tr('Connected. Chip type: {chip_type}').format(
+                          chip_type=esp.get_chip_description()), 0)
+            return esp.run_stub()
+
+        if baudrate:
+            esp = connect()
+            esp.change_baud(baudrate)
+            return esp
+
+        esp, baudrate = self.baudrates.negotiate(device, connect)
+        progress.emit(self.tr('Using {baudrate} baud.').format(
+                      baudrate=baudrate), 0)
         return esp
 
-    def flashBlock(self, uncimage, progress, esp, address):
-        image = zlib.compress(uncimage, 9)
+    def flashBlock(self, uncimage, progress, esp, address, deflated=None):
+        image, blocks = deflated or self.deflate_cache.get(
+            uncimage, esp.FLASH_WRITE_SIZE)
 
-        blocks = esp.flash_defl_begin(len(uncimage), len(image), address)
-        seq = 0
-        written = 0
-        while len(image) > 0:
-            current_addr = address + seq * esp.FLASH_WRITE_SIZE
+        def report(current_addr, seq, blocks):
             progress.emit(self.tr('Writing at 0x{address:08x}...').format(
                           address=current_addr),
                           100 * (seq + 1) // blocks)
 
-            block = image[0:esp.FLASH_WRITE_SIZE]
-            esp.flash_defl_block(block, seq, timeout=3.0)
-            image = image[esp.FLASH_WRITE_SIZE:]
-            seq += 1
-            written += len(block)
-
-
-
+        write_deflated(esp, address, len(uncimage), image, report)
 
     # Zeroconf page
     def discovery_start(self):
@@ -662,49 +1205,116 @@ class MainWindow(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
             self.zeroconf_discovery.stop()
 
         self.zeroconf_discovery = ZeroconfDiscoveryThread()
-        self.zeroconf_discovery.deviceDiscovered.connect(self.on_zeroconf_discovered)
+        self.zeroconf_discovery.deviceAdded.connect(self.on_zeroconf_discovered)
+        self.zeroconf_discovery.deviceUpdated.connect(self.on_zeroconf_discovered)
+        self.zeroconf_discovery.deviceRemoved.connect(self.on_zeroconf_removed)
         self.zeroconf_discovery.start()
-        self.discoveryList.setRowCount(0)
-        self.discoveryList.setSizeAdjustPolicy(QtWidgets.QAbstractScrollArea.AdjustToContents)
-        self.discoveryList.setHorizontalHeaderLabels(['IP', 'Name', 'Version'])
-        header = self.discoveryList.horizontalHeader()
-        header.setSectionResizeMode(2, QtWidgets.QHeaderView.Stretch)
-        header.setSectionResizeMode(0, QtWidgets.QHeaderView.ResizeToContents)
-        header.setSectionResizeMode(1, QtWidgets.QHeaderView.ResizeToContents)
 
-    def on_logmessage_received(self, addr, data):
-        now = datetime.now()
-        rowPosition = 0 # self.logTable.rowCount()
-        self.logTable.insertRow(rowPosition)
+    def on_log_timer(self):
+        """Moves the log lines received since the last tick into the log
+        table, so the table is updated at most once per
+        LOG_REFRESH_INTERVAL no matter how many lines arrive"""
+        self.log_model.extend(self.logger.take())
+
+        # Lines over the rate limit per sender, and lines the table fell
+        # behind on
+        drops = (self.logger.ingest.drop_counts(), self.logger.dropped)
+        if drops != self.log_drops:
+            self.log_drops = drops
+            limited, overflow = drops
+            worst = sorted(limited.items(), key=lambda d: -d[1])[:3]
+            text = self.tr("Dropped: {count} ({senders})").format(
+                count=sum(limited.values()),
+                senders=', '.join('%s: %d' % d for d in worst))
+            if overflow:
+                text += self.tr(", {count} not shown in time").format(
+                    count=overflow)
+            self.logDropLabel.setText(text)
+
+    def on_log_filter_changed(self, *args):
+        """Passes the filters of the log tab on to the listener thread"""
+        self.logger.ingest.configure(
+            muted=self.logMuteText.text().replace(',', ' ').split(),
+            max_severity=(7, 6, 5, 4, 3)[self.logSeverityBox.currentIndex()],
+            rate=self.logRateSpin.value())
+
+    def log_query(self):
+        """Returns the LogStore.query() arguments chosen on the log tab"""
+        hours = (None, 1, 24, 24 * 7)[self.logRangeBox.currentIndex()]
+        return {
+            'since': time.time() - hours * 3600 if hours else None,
+            'address': self.logAddressText.text().strip() or None,
+            'text': self.logSearchText.text() or None,
+        }
+
+    @QtCore.Slot()
+    def on_logSearchButton_clicked(self):
+        if self.search_logs.running():
+            return
+        self.statusbar.showMessage(self.tr("Searching logs..."))
+        self.search_logs(self.log_query(), error=self.errorSignal)
+
+    @QuickThread.wrap
+    def search_logs(self, query):
+        """Emits the newest LOG_CAPACITY stored lines matching query"""
+        results = collections.deque(self.log_store.query(**query),
+                                    maxlen=LOG_CAPACITY)
+        self.logSearchDone.emit(list(results))
+
+    def on_log_search_done(self, entries):
+        self.log_results.clear()
+        self.log_results.extend(entries)
+        self.logTable.setModel(self.log_results)
+        self.logLiveButton.setEnabled(True)
+        self.statusbar.showMessage(
+            self.tr("{count} log lines found.").format(count=len(entries)))
+
+    @QtCore.Slot()
+    def on_logLiveButton_clicked(self):
+        self.logTable.setModel(self.log_model)
+        self.logLiveButton.setEnabled(False)
 
-        self.logTable.setItem(rowPosition , 0, QTableWidgetItem(now.strftime("%H:%M:%S")))
-        self.logTable.setItem(rowPosition , 1, QTableWidgetItem(data))
-        self.logTable.setItem(rowPosition , 2, QTableWidgetItem(addr))
+    @QtCore.Slot()
+    def on_logExportButton_clicked(self):
+        fileName, _ = QFileDialog.getSaveFileName(
+            self, self.tr("Export logs"), "decoder-logs.txt",
+            "Log files (*.txt *.log);;All Files (*)",
+            options=QFileDialog.DontUseNativeDialog)
+        if fileName and not self.export_logs.running():
+            self.export_logs(fileName, self.log_query(),
+                             error=self.errorSignal)
 
+    @QuickThread.wrap
+    def export_logs(self, fname, query):
+        count = self.log_store.export(fname, **query)
+        self.uploadProgress.emit(self.tr(
+            "{count} log lines exported.").format(count=count), 100)
 
     def on_zeroconf_discovered(self, name, address, info):
-        """Called on every zeroconf discovered device"""
-        try:
-         if (name.lower().startswith('ly-dcc-')):
-            rowPosition = self.discoveryList.rowCount()
-            self.discoveryList.insertRow(rowPosition)
-
-            data = QTableWidgetItem(address)
-            data.setData(ROLE_DEVICE, TYP_REMOTE)
-            data.setData(DATA_ADDR, address)
-            data.setData(DATA_NAME, name)
-            data.setData(DATA_INFO, info)
-            self.discoveryList.setItem(rowPosition , 0, data)
-            self.discoveryList.setItem(rowPosition , 1, QTableWidgetItem(name.split('.')[0]))
-            self.discoveryList.setItem(rowPosition , 2, QTableWidgetItem(info.properties.get(b"Version").decode('utf-8')))
-        except:
-            print("Error")
-
-
-    def enableDiscoveryButton(self, selectedTyp):
+        """Called when a decoder has been discovered or its announcement
+        has changed"""
+        version = info.properties.get(b"Version") or b""
+        self.devices.upsert(name, TYP_REMOTE, address, name,
+                            name.split('.')[0],
+                            version.decode('utf-8', 'replace'), info)
+
+    def on_zeroconf_removed(self, name):
+        self.devices.set_online(name, False)
+
+    def enableDiscoveryButton(self, selectedTyp, single=True):
+        """Enables the actions for the selected device type. Flashing works
+        on all selected devices, every other action only on a single one."""
         self.flashTab.setEnabled(selectedTyp == TYP_USB)
-        self.serialConnectButton.setEnabled(selectedTyp == TYP_USB)
+        self.serialConnectButton.setEnabled(
+            selectedTyp == TYP_USB and
+            (single or self.serialConnectButton.isChecked()))
         self.remoteTab.setEnabled(selectedTyp == TYP_REMOTE)
+        for button in (self.eraseButton, self.backupButton,
+                       self.restoreButton, self.uploadSupportFiles,
+                       self.uploadConfigFile, self.discoveryBrowser,
+                       self.enableLoggingButton, self.uploadConfigRemote,
+                       self.uploadSupportRemote):
+            button.setEnabled(single)
 
     @QtCore.Slot()
     def on_discoveryBrowser_clicked(self):
@@ -722,11 +1332,10 @@ class MainWindow(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
         else:
             self.statusbar.showMessage(self.tr('Error {code} : {text}').format(code = str(status_code), text = r.text))
 
-    @QtCore.Slot()
-    def on_discoveryList_itemSelectionChanged(self):
+    def on_discovery_selection_changed(self):
         rows = self.discoveryList.selectionModel().selectedRows()
         typ = rows[0].data(ROLE_DEVICE) if (len(rows) > 0) else TYP_UNKNOWN
-        self.enableDiscoveryButton(typ)
+        self.enableDiscoveryButton(typ, len(rows) <= 1)
 
 
     @QtCore.Slot()
@@ -743,9 +1352,16 @@ class MainWindow(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
 
     @QtCore.Slot()
     def on_discoveryRefreshButton_clicked(self):
+        """Drops offline devices and confirms the network ones again"""
+        self.devices.remove_offline()
+        self.devices.set_typ_online(TYP_REMOTE, False)
         self.discovery_start()
         self.port_detect.restart()
 
+    @QtCore.Slot(int)
+    def on_discoveryTransportBox_currentIndexChanged(self, index):
+        self.device_filter.set_typ((None, TYP_USB, TYP_REMOTE)[index])
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
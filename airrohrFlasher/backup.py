@@ -0,0 +1,178 @@
+"""Flash backups of boards, stored as images that can be flashed back"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+
+from esptool import DETECTED_FLASH_SIZES, flash_size_bytes
+
+from .utils import translator, write_json
+
+# ESP32 partition table location and entry layout (esp_partition.h)
+PARTITION_TABLE_ADDRESS = 0x8000
+PARTITION_TABLE_SIZE = 0xC00
+PARTITION_ENTRY = struct.Struct('<2sBBII16sI')
+PARTITION_MAGIC = b'\xaa\x50'
+
+# Bootloader (at 0x1000) and partition table, in front of the partitions
+BOOT_REGION = (0x0, PARTITION_TABLE_ADDRESS + PARTITION_TABLE_SIZE)
+
+# Data partition subtypes holding configuration and file systems: nvs,
+# nvs_keys, esphttpd, fat, spiffs and littlefs
+CONFIG_SUBTYPES = (0x02, 0x04, 0x80, 0x81, 0x82, 0x83)
+PARTITION_TYPE_DATA = 0x01
+
+Partition = collections.namedtuple('Partition',
+                                   'name type subtype address size')
+
+
+_translate = translator('BackupStore')
+
+
+class BackupError(Exception):
+    pass
+
+
+def parse_partition_table(data):
+    """Returns the Partitions of a raw partition table, an empty list if
+    data does not contain one (e.g. ESP8266 boards)"""
+    partitions = []
+    for offset in range(0, len(data) - PARTITION_ENTRY.size + 1,
+                        PARTITION_ENTRY.size):
+        magic, typ, subtype, address, size, name, _ = \
+            PARTITION_ENTRY.unpack_from(data, offset)
+        if magic != PARTITION_MAGIC:
+            # End of table, optionally preceded by its MD5 entry
+            break
+        partitions.append(Partition(
+            name.rstrip(b'\0').decode('ascii', 'replace'), typ, subtype,
+            address, size))
+    return partitions
+
+
+def read_partition_table(esp):
+    return parse_partition_table(
+        esp.read_flash(PARTITION_TABLE_ADDRESS, PARTITION_TABLE_SIZE))
+
+
+def config_partitions(partitions):
+    """Returns the partitions holding the configuration and file system"""
+    return [p for p in partitions if p.type == PARTITION_TYPE_DATA and
+            p.subtype in CONFIG_SUBTYPES]
+
+
+def read_mac(esp):
+    """Returns the MAC address of the board as aa:bb:cc:dd:ee:ff"""
+    return ':'.join('%02x' % b for b in esp.read_mac())
+
+
+def detect_flash_size(esp):
+    """Returns the flash size in bytes reported by the flash chip, None if
+    it is unknown"""
+    size = DETECTED_FLASH_SIZES.get((esp.flash_id() >> 16) & 0xff)
+    return flash_size_bytes(size) if size else None
+
+
+def backup_regions(esp, names=None):
+    """Returns (partition table, [(address, length)]) of the regions to
+    back up: the whole flash, or only the partitions called names"""
+    partitions = read_partition_table(esp)
+    if not names:
+        size = detect_flash_size(esp)
+        if size is None:
+            raise BackupError(_translate('Unknown flash size'))
+        return partitions, [(0x0, size)]
+
+    by_name = {p.name: p for p in partitions}
+    missing = [name for name in names if name not in by_name]
+    if missing:
+        raise BackupError(_translate(
+            'Unknown partitions: {missing} (available: {available})').format(
+                missing=', '.join(missing),
+                available=', '.join(p.name for p in partitions) or '-'))
+    return partitions, sorted((by_name[name].address, by_name[name].size)
+                              for name in names)
+
+
+def chunk_ranges(address, length, chunk_size):
+    """Yields (address, length) of a region split into chunks"""
+    for offset in range(0, length, chunk_size):
+        yield address + offset, min(chunk_size, length - offset)
+
+
+class BackupStore(object):
+    """Keeps backups in `path` as ZIP images with one deflated entry per
+    region named by its address ("0x8000"), the format read_segments()
+    flashes. Files are named by the sha256 of all their regions, so backing
+    up an unchanged board again only adds an index entry. Deduplication
+    works on whole images only: backups sharing most of their content (e.g.
+    the same firmware with another configuration) are stored in full, each
+    compressed on its own."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.index_fname = os.path.join(path, 'index.json')
+
+        os.makedirs(path, exist_ok=True)
+        try:
+            with open(self.index_fname) as fd:
+                self.index = json.load(fd)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def _save_index(self):
+        write_json(self.index_fname, self.index, indent=1)
+
+    @staticmethod
+    def _digest(segments):
+        h = hashlib.sha256()
+        for address, data in segments:
+            h.update(struct.pack('<II', address, len(data)))
+            h.update(data)
+        return h.hexdigest()
+
+    def fname(self, digest):
+        return os.path.join(self.path, digest + '.zip')
+
+    def add(self, segments, **info):
+        """Stores (address, data) segments and returns (file name, info) of
+        the image. info is kept in the index along with the time of the
+        backup."""
+        digest = self._digest(segments)
+        fname = self.fname(digest)
+        if not os.path.exists(fname):
+            fd, tmp = tempfile.mkstemp(dir=self.path)
+            try:
+                with os.fdopen(fd, 'wb') as f, \
+                        zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as zf:
+                    for address, data in segments:
+                        zf.writestr('0x%x' % address, bytes(data))
+                os.replace(tmp, fname)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        else:
+            logging.info('Backup %s already stored', digest)
+
+        info = dict(info, time=time.time())
+        with self.lock:
+            self.index[digest] = info
+            self._save_index()
+        return fname, info
+
+    def entries(self):
+        """Returns (file name, info) of all stored backups, newest first"""
+        with self.lock:
+            items = sorted(self.index.items(),
+                           key=lambda item: item[1].get('time', 0),
+                           reverse=True)
+        return [(self.fname(digest), info) for digest, info in items
+                if os.path.exists(self.fname(digest))]
@@ -0,0 +1,164 @@
+"""Per adapter baud rate negotiation for the flasher stub"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import serial.tools.list_ports
+
+from .utils import write_json
+
+
+def adapter_key(device):
+    """Identifies the USB serial adapter behind device by vid:pid and its
+    serial number (or USB location when it has none)"""
+    for port in serial.tools.list_ports.comports():
+        if port.device == device and port.vid is not None:
+            return '%04x:%04x:%s' % (port.vid, port.pid,
+                                     port.serial_number or port.location)
+    return device
+
+
+class BaudNegotiator(object):
+    """Finds the fastest baud rate a board handles reliably once a stub is
+    running. Candidate rates are tried in ascending order, each checked by
+    reading a flash sector and comparing it with the MD5 the stub computes
+    on the board. The first failure ends the search; the board is then
+    reconnected and used at the last good rate, or at the baseline rate if
+    nothing faster than the ROM rate worked but the baseline does. Results
+    are kept per adapter in a JSON file, so later connections start from
+    the known rate. A failing rate caps later searches only after it failed
+    max_failures times in a row, and only for failed_ttl seconds; until then
+    it is probed again, so a single glitch does not slow down an adapter for
+    good."""
+
+    check_size = 0x1000
+    max_failures = 2
+    failed_ttl = 24 * 3600
+
+    def __init__(self, fname, candidates, fallback, baseline):
+        self.fname = fname
+        self.candidates = sorted(candidates)
+        self.fallback = fallback
+        self.baseline = baseline
+        self.lock = threading.Lock()
+        try:
+            with open(fname) as fd:
+                self.results = json.load(fd)
+        except (OSError, ValueError):
+            self.results = {}
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+            write_json(self.fname, self.results, indent=1)
+        except OSError as exc:
+            logging.warning('Saving baud rates failed: %s', exc)
+
+    def _expired(self, result):
+        return time.time() - result.get('failed_at', 0) >= self.failed_ttl
+
+    def _record(self, key, best=None, failed=None):
+        with self.lock:
+            result = self.results.setdefault(key, {})
+            if best is not None:
+                result['best'] = best
+                if result.get('failed') and best >= result['failed']:
+                    for field in ('failed', 'failures', 'failed_at'):
+                        result.pop(field, None)
+            if failed is not None:
+                if failed == result.get('failed') and \
+                        not self._expired(result):
+                    result['failures'] = result.get('failures', 0) + 1
+                elif (not result.get('failed') or failed < result['failed'] or
+                      self._expired(result)):
+                    result['failed'] = failed
+                    result['failures'] = 1
+                result['failed_at'] = time.time()
+                if result.get('best', 0) >= failed:
+                    del result['best']
+            self._save()
+
+    def _limit(self, known):
+        """Returns the rate searches must stay below, None if no rate failed
+        often and recently enough"""
+        if (known.get('failed') and
+                known.get('failures', 0) >= self.max_failures and
+                not self._expired(known)):
+            return known['failed']
+        return None
+
+    def check(self, esp, baudrate):
+        """Switches esp to baudrate and returns whether a read/MD5 round
+        trip succeeds"""
+        try:
+            esp.change_baud(baudrate)
+            data = esp.read_flash(0, self.check_size)
+            return (hashlib.md5(data).hexdigest() ==
+                    esp.flash_md5sum(0, self.check_size))
+        except Exception as exc:
+            logging.info('%d baud failed: %s', baudrate, exc)
+            return False
+
+    @staticmethod
+    def _close(esp):
+        try:
+            esp._port.close()
+        except Exception:
+            pass
+
+    def _recover(self, esp, connect, best, failed):
+        """Reconnects after a failed check and returns (esp, baudrate)
+        running at the last good rate, or at the baseline rate if that is
+        faster and passes the check"""
+        self._close(esp)
+        esp = connect()
+        if best < self.baseline and failed != self.baseline:
+            if self.check(esp, self.baseline):
+                return esp, self.baseline
+            self._close(esp)
+            esp = connect()
+        if best != self.fallback:
+            esp.change_baud(best)
+        return esp, best
+
+    def negotiate(self, device, connect):
+        """Returns (esp, baudrate) with the stub of the board at device
+        running at the fastest reliable rate. connect() must open the board
+        and return a stub ESPLoader running at the ROM baud rate."""
+        key = adapter_key(device)
+        with self.lock:
+            known = dict(self.results.get(key, {}))
+        limit = self._limit(known)
+
+        esp = connect()
+        best = self.fallback
+        if known.get('best'):
+            if self.check(esp, known['best']):
+                # Faster rates are probed again unless they failed
+                # repeatedly and recently
+                best = known['best']
+            else:
+                logging.info('%s no longer runs at %d baud', key,
+                             known['best'])
+                self._record(key, failed=known['best'])
+                limit = min(known['best'], limit or known['best'])
+                self._close(esp)
+                esp = connect()
+
+        for baudrate in self.candidates:
+            if baudrate <= best:
+                continue
+            if limit and baudrate >= limit:
+                break
+            if not self.check(esp, baudrate):
+                self._record(key, failed=baudrate)
+                esp, best = self._recover(esp, connect, best, baudrate)
+                break
+            best = baudrate
+
+        self._record(key, best=best)
+        return esp, best
@@ -0,0 +1,183 @@
+"""Persistent, content addressed cache for downloaded files"""
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+from .utils import write_json
+
+
+class FirmwareCache(object):
+    """Keeps downloads in `path` named by the sha256 of their content. An
+    index maps every URL to its blob together with the ETag/Last-Modified
+    validators used to revalidate it with a conditional GET. Blobs are
+    verified on every read and least recently used ones are evicted once the
+    cache grows above `max_size` bytes."""
+
+    def __init__(self, path, max_size, session=None):
+        self.path = path
+        self.max_size = max_size
+        self.session = session or requests.Session()
+        self.lock = threading.RLock()
+        self.index_fname = os.path.join(path, 'index.json')
+
+        os.makedirs(os.path.join(path, 'blobs'), exist_ok=True)
+        self.index = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_fname) as fd:
+                index = json.load(fd)
+            if 'urls' in index and 'blobs' in index:
+                return index
+        except (OSError, ValueError):
+            pass
+        return {'urls': {}, 'blobs': {}}
+
+    def _save_index(self):
+        write_json(self.index_fname, self.index)
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, 'blobs', digest)
+
+    @staticmethod
+    def _digest(fname):
+        h = hashlib.sha256()
+        with open(fname, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(1024 * 1024), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _entry(self, url):
+        """Returns a copy of the index entry of url if its blob is intact.
+        Corrupted or missing blobs are dropped from the cache."""
+        with self.lock:
+            entry = self.index['urls'].get(url)
+            if not entry:
+                return None
+            entry = dict(entry)
+
+        fname = self.blob_path(entry['sha256'])
+        try:
+            intact = self._digest(fname) == entry['sha256']
+        except OSError:
+            intact = False
+
+        with self.lock:
+            if not intact:
+                logging.warning('Dropping corrupted cache entry for %s', url)
+                self._remove_blob(entry['sha256'])
+                self._save_index()
+                return None
+
+            blob = self.index['blobs'].get(entry['sha256'])
+            if blob:
+                blob['atime'] = time.time()
+                self._save_index()
+        return entry
+
+    def lookup(self, url):
+        """Returns the path of a verified cached copy of url without
+        touching the network, or None"""
+        entry = self._entry(url)
+        return self.blob_path(entry['sha256']) if entry else None
+
+    def fetch(self, url, progress=None, timeout=30):
+        """Returns the path of an up to date copy of url. A cached copy is
+        revalidated with a conditional GET and used as is when the server is
+        unreachable. progress(done, total) is called while downloading."""
+        entry = self._entry(url)
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            response = self.session.get(url, headers=headers, stream=True,
+                                        timeout=timeout)
+        except requests.RequestException:
+            if not entry:
+                raise
+            logging.warning('Revalidating %s failed, using cached copy', url)
+            return self.blob_path(entry['sha256'])
+
+        with response:
+            if entry and response.status_code == 304:
+                return self.blob_path(entry['sha256'])
+
+            response.raise_for_status()
+            return self._store(url, response, progress)
+
+    def prefetch(self, urls, workers=4):
+        """Fetches all urls concurrently and yields (url, path) as soon as
+        each download is available, in order of completion"""
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers) as pool:
+            jobs = {pool.submit(self.fetch, url): url for url in urls}
+            for job in concurrent.futures.as_completed(jobs):
+                yield jobs[job], job.result()
+
+    def _store(self, url, response, progress):
+        total = int(response.headers.get('content-length') or 0)
+        h = hashlib.sha256()
+        done = 0
+
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if progress:
+                    progress(done, total)
+                for data in response.iter_content(chunk_size=64 * 1024):
+                    f.write(data)
+                    h.update(data)
+                    done += len(data)
+                    if progress:
+                        progress(done, total)
+
+            digest = h.hexdigest()
+            os.replace(tmp, self.blob_path(digest))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        with self.lock:
+            self.index['urls'][url] = {
+                'sha256': digest,
+                'etag': response.headers.get('etag'),
+                'last_modified': response.headers.get('last-modified'),
+            }
+            self.index['blobs'][digest] = {'size': done, 'atime': time.time()}
+            self._evict(keep=digest)
+            self._save_index()
+
+        return self.blob_path(digest)
+
+    def _remove_blob(self, digest):
+        self.index['blobs'].pop(digest, None)
+        for url in [u for u, e in self.index['urls'].items()
+                    if e['sha256'] == digest]:
+            del self.index['urls'][url]
+        try:
+            os.unlink(self.blob_path(digest))
+        except OSError:
+            pass
+
+    def _evict(self, keep=None):
+        blobs = self.index['blobs']
+        total = sum(b['size'] for b in blobs.values())
+        for digest in sorted(blobs, key=lambda d: blobs[d]['atime']):
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            total -= blobs[digest]['size']
+            self._remove_blob(digest)
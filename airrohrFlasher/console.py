@@ -0,0 +1,70 @@
+"""Serial monitor helpers: incremental decoding and capture to file"""
+
+import codecs
+import time
+
+
+class ConsoleBuffer(object):
+    """Collects text received on the serial monitor until the GUI takes it.
+    UTF-8 sequences split between reads are decoded once complete, invalid
+    bytes are replaced. At most max_chars characters are kept; older text
+    would be scrolled out of the monitor anyway."""
+
+    def __init__(self, max_chars):
+        self.max_chars = max_chars
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.pending = []
+        self.size = 0
+
+    def feed(self, data):
+        text = self.decoder.decode(data).replace('\r', '')
+        if not text:
+            return
+        self.pending.append(text)
+        self.size += len(text)
+        if self.size > 2 * self.max_chars:
+            text = ''.join(self.pending)[-self.max_chars:]
+            self.pending = [text]
+            self.size = len(text)
+
+    def take(self):
+        """Returns and clears the text received since the last call"""
+        text = ''.join(self.pending)
+        self.pending = []
+        self.size = 0
+        return text
+
+
+class ConsoleCapture(object):
+    """Writes the raw bytes received on the serial monitor to a file,
+    prefixing every line with the time its first byte arrived. Every batch
+    is flushed, so a crash loses nothing already received."""
+
+    def __init__(self, fname):
+        self.fd = open(fname, 'ab')
+        self.line_start = True
+
+    def _stamp(self, now):
+        return time.strftime('[%Y-%m-%d %H:%M:%S', time.localtime(now)) + \
+            '.%03d] ' % (int(now * 1000) % 1000)
+
+    def write(self, data, now=None):
+        now = time.time() if now is None else now
+        stamp = self._stamp(now).encode('ascii')
+        lines = data.split(b'\n')
+        out = []
+        for i, line in enumerate(lines):
+            last = i == len(lines) - 1
+            if last and not line:
+                break
+            if self.line_start:
+                out.append(stamp)
+            out.append(line)
+            if not last:
+                out.append(b'\n')
+            self.line_start = not last
+        self.fd.write(b''.join(out))
+        self.fd.flush()
+
+    def close(self):
+        self.fd.close()
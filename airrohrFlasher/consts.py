@@ -1,3 +1,4 @@
+import os
 import sys
 
 from .qtvariant import QtCore
@@ -7,6 +8,12 @@ from .qtvariant import QtCore
 UPDATE_REPOSITORY = 'https://raw.githubusercontent.com/littleyoda/littleyoda-DCC-Decoder/flashinfo/flash.json'
 UPDATE_SUPPORTFILES = 'https://raw.githubusercontent.com/littleyoda/littleyoda-DCC-Decoder/flashinfo/supportfiles.json'
 
+# All firmware indexes offered, merged in this order. Further indexes (e.g. an
+# internal test channel) can be added as space separated URLs in the
+# LYDCC_UPDATE_REPOSITORIES environment variable.
+UPDATE_REPOSITORIES = [UPDATE_REPOSITORY] + \
+    os.environ.get('LYDCC_UPDATE_REPOSITORIES', '').split()
+
 
 # URI prefixes (protocol parts, essentially) to be downloaded using requests
 ALLOWED_PROTO = ('https://')
@@ -28,6 +35,7 @@ DATA_INFO = QtCore.Qt.UserRole + 4
 TYP_REMOTE = QtCore.Qt.UserRole + 5
 TYP_USB = QtCore.Qt.UserRole + 6
 TYP_UNKNOWN = QtCore.Qt.UserRole + 7
+DATA_ONLINE = QtCore.Qt.UserRole + 8
 
 if sys.platform.startswith('darwin'):
     DRIVERS_URL = 'http://www.wch.cn/downloads/CH341SER_MAC_ZIP.html'
@@ -35,3 +43,89 @@ elif sys.platform.startswith(('cygwin', 'win32')):
     DRIVERS_URL = 'http://www.wch.cn/downloads/CH341SER_ZIP.html'
 else:
     DRIVERS_URL = None
+
+# Persistent cache for downloaded firmware images
+if sys.platform.startswith(('cygwin', 'win32')):
+    CACHE_DIR = os.path.join(os.environ.get('LOCALAPPDATA', os.path.expanduser('~')),
+                             'littleyoda-flasher', 'cache')
+elif sys.platform.startswith('darwin'):
+    CACHE_DIR = os.path.expanduser('~/Library/Caches/littleyoda-flasher')
+else:
+    CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                             'littleyoda-flasher')
+
+# User data that must survive cache cleanups (flash backups)
+if sys.platform.startswith(('cygwin', 'win32')):
+    DATA_DIR = os.path.join(os.environ.get('APPDATA', os.path.expanduser('~')),
+                            'littleyoda-flasher')
+elif sys.platform.startswith('darwin'):
+    DATA_DIR = os.path.expanduser('~/Library/Application Support/littleyoda-flasher')
+else:
+    DATA_DIR = os.path.join(os.environ.get('XDG_DATA_HOME', os.path.expanduser('~/.local/share')),
+                            'littleyoda-flasher')
+
+# Least recently used files are evicted above this size (bytes)
+CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+# Deflated flash segments kept in memory for repeated flashing (bytes)
+DEFLATE_CACHE_SIZE = 64 * 1024 * 1024
+
+# Granularity of the flash/image comparison for delta flashing
+DELTA_REGION_SIZE = 0x10000
+
+# Runs of erased (0xFF) sectors at least this long are erased, not written
+ERASED_SKIP_SIZE = 0x10000
+
+# Serial file transfer: segment size and maximum number of segments in flight
+# for firmware supporting windowed transfers. Asking the firmware for windowed
+# transfer support costs firmware without it a one second timeout per
+# transfer session, so the query is opt-in: LYDCC_TRANSFER_WINDOW=8 enables it.
+TRANSFER_SEGMENT_SIZE = 1024
+TRANSFER_WINDOW = int(os.environ.get('LYDCC_TRANSFER_WINDOW', 1))
+
+# Concurrent uploads and retries per device of network firmware updates
+OTA_WORKERS = 4
+OTA_RETRIES = 2
+
+# Baud rates tried for flashing, the best one working with an adapter is
+# remembered in BAUDRATE_CACHE. Adapters failing the first candidate are
+# still used at FLASH_BASELINE_BAUDRATE if that rate works.
+FLASH_BAUDRATES = [230400, 460800, 921600, 1500000]
+FLASH_BASELINE_BAUDRATE = 460800
+BAUDRATE_CACHE = os.path.join(CACHE_DIR, 'baudrates.json')
+
+# Flash backups: directory, size of a single read and how often a failed
+# read is retried on a new connection
+BACKUP_DIR = os.path.join(DATA_DIR, 'backups')
+BACKUP_CHUNK_SIZE = 0x40000
+BACKUP_RETRIES = 3
+
+# Seconds a board stays in the flasher stub after the last operation before
+# it is reset into its firmware
+SESSION_IDLE_TIMEOUT = 5
+
+# Serial monitor: offered baud rates, lines kept in the monitor and its
+# refresh period (ms)
+SERIAL_BAUDRATES = [9600, 57600, 74880, 115200, 230400, 460800, 921600,
+                    1500000, 2000000]
+SERIAL_DEFAULT_BAUDRATE = 115200
+SERIAL_SCROLLBACK = 5000
+SERIAL_REFRESH_INTERVAL = 50
+
+# Remote logging: UDP port, log lines kept in memory and GUI refresh period
+# (ms) of the log table
+LOG_PORT = 5514
+LOG_CAPACITY = 10000
+LOG_REFRESH_INTERVAL = 100
+
+# Received log lines are kept on disk in gzip compressed segments of about
+# LOG_SEGMENT_SIZE bytes (before compression), the oldest ones are deleted
+# above LOG_STORE_MAX_SIZE bytes. They are kept with the backups, not in the
+# cache directory, which may be cleared at any time.
+LOG_DIR = os.path.join(DATA_DIR, 'logs')
+LOG_SEGMENT_SIZE = 4 * 1024 * 1024
+LOG_STORE_MAX_SIZE = 256 * 1024 * 1024
+
+# Log lines accepted per second and sender, and the burst allowed above that
+LOG_RATE_LIMIT = 50
+LOG_BURST = 200
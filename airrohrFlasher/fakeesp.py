@@ -0,0 +1,220 @@
+"""Pseudo terminal emulating the serial file transfer of a decoder.
+
+Run `python -m airrohrFlasher.fakeesp` and point the flasher at the printed
+device to try uploads without hardware, or pass --bench to measure the
+throughput of SerialTransfer against it. The link speed is emulated by
+delaying every byte according to --baud."""
+
+import argparse
+import base64
+import os
+import queue
+import random
+import re
+import threading
+import time
+import tty
+
+
+class FakeESP(object):
+    """Speaks the debug console side of the PUT transfer on a pty.
+    windowed=False emulates firmware without the CAP command; otherwise
+    segments are framed for windowed transfers once a session has sent
+    CAP, and sent stop-and-wait without it. Bytes reach
+    the fake at the emulated line rate plus half the USB round trip
+    latency, processing a segment takes write_delay seconds."""
+
+    def __init__(self, baudrate=115200, windowed=True, window=8,
+                 segment_size=1024, fail_rate=0.0, write_delay=0.01,
+                 latency=0.004):
+        self.baudrate = baudrate
+        self.windowed = windowed
+        self.window = window
+        self.segment_size = segment_size
+        self.fail_rate = fail_rate
+        self.write_delay = write_delay
+        self.latency = latency
+        self.files = {}
+        self.failures = 0
+
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.device = os.ttyname(slave)
+        self._slave = slave
+        self.buf = b''
+        self.incoming = queue.Queue()
+        self.outgoing = queue.Queue()
+
+    def start(self):
+        for target in (self.run, self._receiver, self._sender):
+            threading.Thread(target=target, daemon=True).start()
+
+    def _duration(self, count):
+        # 10 bits per byte on a 8N1 line
+        return count * 10.0 / self.baudrate
+
+    def _receiver(self):
+        clock = 0
+        while True:
+            chunk = os.read(self.master, 64)
+            clock = max(clock, time.time()) + self._duration(len(chunk))
+            self.incoming.put((clock + self.latency / 2, chunk))
+
+    def _sender(self):
+        while True:
+            due, data = self.outgoing.get()
+            time.sleep(max(0, due - time.time()))
+            os.write(self.master, data)
+
+    def send(self, line):
+        data = (line + "\r\n").encode('utf-8')
+        self.outgoing.put((time.time() + self.latency / 2 +
+                           self._duration(len(data)), data))
+
+    def _fill(self):
+        due, chunk = self.incoming.get()
+        time.sleep(max(0, due - time.time()))
+        self.buf += chunk
+
+    def read(self, count):
+        """Returns exactly count bytes from the host"""
+        while len(self.buf) < count:
+            self._fill()
+        data, self.buf = self.buf[:count], self.buf[count:]
+        return data
+
+    def expect(self, token):
+        """Drops input until token has been received"""
+        while token not in self.buf:
+            self._fill()
+        self.buf = self.buf[self.buf.index(token) + len(token):]
+
+    def run(self):
+        while True:
+            self.expect(b'xdebug')
+            self.send("Debugmodus aktiviert")
+            self.expect(b'_')
+            self.send("TRANSFER ACTIVE")
+            self.session()
+
+    def session(self):
+        negotiated = False
+        while True:
+            while not self.buf:
+                self._fill()
+
+            if self.buf.startswith(b'x'):
+                self.buf = self.buf[1:]
+                self.send("TRANSFER INACTIVE")
+                return
+            if b'\n' not in self.buf:
+                self._fill()
+                continue
+
+            line, self.buf = self.buf.split(b'\n', 1)
+            line = line.decode('iso-8859-1').strip()
+            if line == 'CAP' and self.windowed:
+                negotiated = True
+                self.send("CAP WINDOW=%d SEGMENT=%d" % (self.window,
+                                                       self.segment_size))
+            elif line.startswith('PUT '):
+                _, length, fname = line.split(' ', 2)
+                if negotiated:
+                    data = self.receive_windowed(int(length))
+                else:
+                    data = self.receive_legacy(int(length))
+                self.files[fname] = base64.b64decode(data)
+                self.send("TRANSFER END")
+
+    def _failed(self):
+        if random.random() < self.fail_rate:
+            self.failures += 1
+            return True
+        time.sleep(self.write_delay)
+        return False
+
+    def receive_legacy(self, length):
+        data = b''
+        while len(data) < length:
+            segment = self.read(min(500, length - len(data)))
+            if self._failed():
+                self.send("SEGMENT FAIL %d" % len(data))
+                continue
+            data += segment
+            self.send("SEGMENT OK %d" % len(data))
+        return data
+
+    def receive_windowed(self, length):
+        data = b''
+        header = re.compile(rb'@(\d+),(\d+):')
+        while len(data) < length:
+            self.expect(b'@')
+            while b':' not in self.buf:
+                self._fill()
+            match = header.match(b'@' + self.buf)
+            if not match:
+                continue
+            self.buf = self.buf[match.end() - 1:]
+            offset, size = int(match.group(1)), int(match.group(2))
+            segment = self.read(size)
+
+            if offset < len(data):
+                # Duplicate, its acknowledgement got lost
+                self.send("SEGMENT OK %d" % offset)
+                continue
+            if offset > len(data):
+                # Sent after a failed segment, waiting for the resend
+                continue
+            if self._failed():
+                self.send("SEGMENT FAIL %d" % offset)
+                continue
+            data += segment
+            self.send("SEGMENT OK %d" % offset)
+        return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--legacy', action='store_true',
+                        help='emulate firmware without windowed transfers')
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.004,
+                        help='USB round trip latency in seconds')
+    parser.add_argument('--write-delay', type=float, default=0.01,
+                        help='seconds the firmware needs per segment')
+    parser.add_argument('--bench', type=int, metavar='BYTES',
+                        help='measure the transfer of BYTES random bytes')
+    parser.add_argument('--window', type=int, default=8,
+                        help='window requested by --bench, 1 skips CAP')
+    args = parser.parse_args()
+
+    esp = FakeESP(args.baud, not args.legacy, fail_rate=args.fail_rate,
+                  write_delay=args.write_delay, latency=args.latency)
+    esp.start()
+
+    if not args.bench:
+        print(esp.device)
+        while True:
+            time.sleep(1)
+
+    import serial
+    from .transfer import SerialTransfer
+
+    content = os.urandom(args.bench)
+    with serial.Serial(esp.device, args.baud, timeout=1) as ser:
+        transfer = SerialTransfer(ser, window=args.window)
+        transfer.enter()
+        t = time.time()
+        transfer.put('bench.bin', content)
+        t = time.time() - t
+        transfer.leave()
+
+    assert esp.files['bench.bin'] == content, 'Transferred file differs'
+    print('%d bytes in %.2f s (%.0f B/s), window %d, %d failed segments' % (
+        len(content), t, len(content) / t, transfer.max_window,
+        esp.failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Low level flash operations on a stub-loaded ESPLoader"""
+
+import hashlib
+import time
+
+from .image import region_digests
+
+
+class VerifyError(Exception):
+    pass
+
+
+class EraseError(Exception):
+    pass
+
+
+def write_deflated(esp, address, size, compressed, report=None):
+    """Streams a deflated segment of `size` uncompressed bytes to the board.
+    Blocks are memoryview slices of the compressed image, so advancing to the
+    next block never copies the remaining data. report(address, seq, blocks)
+    is called before each block is sent."""
+    view = memoryview(compressed)
+    block_size = esp.FLASH_WRITE_SIZE
+
+    blocks = esp.flash_defl_begin(size, len(view), address)
+    for seq in range(blocks):
+        if report:
+            report(address + seq * block_size, seq, blocks)
+        esp.flash_defl_block(view[seq * block_size:(seq + 1) * block_size],
+                             seq, timeout=3.0)
+    return blocks
+
+
+def changed_ranges(esp, address, data, region_size):
+    """Compares the flash content at address with data using the stub's MD5
+    command and returns the (offset, length) ranges of data that differ.
+    Adjacent changed regions are merged into one range."""
+    if esp.flash_md5sum(address, len(data)) == hashlib.md5(data).hexdigest():
+        return []
+
+    ranges = []
+    for offset, length, digest in region_digests(address, data, region_size):
+        if esp.flash_md5sum(address + offset, length) == digest:
+            continue
+        if ranges and sum(ranges[-1]) == offset:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+        else:
+            ranges.append((offset, length))
+    return ranges
+
+
+def verify_segments(esp, segments, digests, report=None):
+    """Compares the MD5 the stub computes over each (address, data) segment
+    with its locally computed md5 hex digest. report(address, length, ok,
+    seconds) is called for every segment. Returns the addresses of the
+    segments that differ."""
+    failed = []
+    for (address, data), digest in zip(segments, digests):
+        t = time.time()
+        ok = esp.flash_md5sum(address, len(data)) == digest
+        if report:
+            report(address, len(data), ok, time.time() - t)
+        if not ok:
+            failed.append(address)
+    return failed
+
+
+def erase_regions(esp, steps, report=None, block_size=0x10000):
+    """Erases (address, length) steps as planned by plan_erase(). Sector
+    steps already erased, as told by the MD5 the stub computes over them,
+    are skipped. Block aligned steps are always erased, checking them would
+    take about as long as the block erase itself. report(address, length,
+    skipped) is called before every step. Returns the number of bytes
+    erased."""
+    erased = 0
+    for address, length in steps:
+        skipped = ((address % block_size or length % block_size) and
+                   esp.flash_md5sum(address, length) ==
+                   hashlib.md5(b'\xff' * length).hexdigest())
+        if report:
+            report(address, length, skipped)
+        if not skipped:
+            esp.erase_region(address, length)
+            erased += length
+    return erased
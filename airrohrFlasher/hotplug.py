@@ -0,0 +1,75 @@
+"""Serial port hotplug notifications"""
+
+import logging
+import select
+import socket
+
+# Kernel uevent netlink protocol and its multicast group (linux/netlink.h)
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP_KERNEL = 1
+
+
+def port_key(port):
+    """Identifies a board by USB vid/pid, serial number and location, so it
+    keeps its identity when the order of device nodes changes. Ports without
+    USB information are identified by their device name."""
+    return (port.vid, port.pid, port.serial_number,
+            port.location or port.device)
+
+
+def diff_ports(old, new):
+    """Returns (added, removed) ListPortInfo lists between two dicts
+    mapping port_key() to ports. A board showing up under another device
+    node counts as removed and added."""
+    added = [p for k, p in new.items()
+             if k not in old or old[k].device != p.device]
+    removed = [p for k, p in old.items()
+               if k not in new or new[k].device != p.device]
+    return added, removed
+
+
+class UeventMonitor(object):
+    """Receives kernel uevents of the tty subsystem from a netlink socket.
+    Only available on Linux, create() returns None elsewhere or when the
+    socket is not permitted (e.g. in some containers)."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    @classmethod
+    def create(cls):
+        if not hasattr(socket, 'AF_NETLINK'):
+            return None
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                 NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, UEVENT_GROUP_KERNEL))
+        except OSError as exc:
+            logging.info('No uevent socket (%s), polling serial ports', exc)
+            return None
+        return cls(sock)
+
+    def wait(self, settle=0.2):
+        """Blocks until a tty device has been added or removed. Events
+        following within settle seconds are collected as well, so plugging
+        a board causes a single rescan."""
+        while not self._receive(None):
+            pass
+        while self._receive(settle) is not None:
+            pass
+
+    def _receive(self, timeout):
+        """Returns whether the next uevent concerns a tty, None on timeout"""
+        if not select.select([self.sock], [], [], timeout)[0]:
+            return None
+        try:
+            data = self.sock.recv(16384)
+        except OSError:
+            # ENOBUFS: events got lost, rescan to be safe
+            return True
+        fields = data.split(b'\0')
+        return (b'SUBSYSTEM=tty' in fields and
+                (b'ACTION=add' in fields or b'ACTION=remove' in fields))
+
+    def close(self):
+        self.sock.close()
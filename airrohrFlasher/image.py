@@ -0,0 +1,195 @@
+"""Helpers preparing firmware images before they are written to a board"""
+
+import collections
+import concurrent.futures
+import hashlib
+import os
+import threading
+import zipfile
+import zlib
+
+
+def read_segments(binary_uri):
+    """Returns list of (address, data) tuples of an image file. ZIP images
+    contain one entry per segment named by its address ("0x1000"), plain
+    images are written to 0x0"""
+    if not zipfile.is_zipfile(binary_uri):
+        with open(binary_uri, 'rb') as fd:
+            return [(0x0, fd.read())]
+
+    segments = []
+    with zipfile.ZipFile(binary_uri) as myzip:
+        for fname in myzip.namelist():
+            if fname.startswith("0x"):
+                segments.append((int(fname, 16), myzip.read(fname)))
+            else:
+                print("Cannot handle " + fname)
+    return segments
+
+
+class DeflateCache(object):
+    """Keeps level 9 deflated segments together with their block count,
+    keyed by sha256 of the segment and the flash write block size. Boards
+    flashed with the same image share a single compression run, even when
+    they ask for it at the same time."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.sizes = {}
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, data, block_size):
+        """Returns (compressed, blocks) of data"""
+        key = (hashlib.sha256(data).digest(), block_size)
+        with self.lock:
+            future = self.entries.get(key)
+            owner = future is None
+            if owner:
+                future = self.entries[key] = concurrent.futures.Future()
+            else:
+                self.entries.move_to_end(key)
+
+        if owner:
+            try:
+                compressed = zlib.compress(data, 9)
+            except Exception as exc:
+                with self.lock:
+                    self.entries.pop(key, None)
+                future.set_exception(exc)
+                raise
+            blocks = (len(compressed) + block_size - 1) // block_size
+            future.set_result((compressed, blocks))
+            self._evict(key, len(compressed))
+
+        return future.result()
+
+    def _evict(self, key, added):
+        with self.lock:
+            if key in self.entries:
+                self.sizes[key] = added
+            while (sum(self.sizes.values()) > self.max_size and
+                   len(self.entries) > 1):
+                old, _ = self.entries.popitem(last=False)
+                self.sizes.pop(old, None)
+
+    def prepare(self, segments, block_size):
+        """Yields (compressed, blocks) of all (address, data) segments in
+        order. All segments are deflated in parallel in the background, so a
+        caller can write the first one while the others are still being
+        compressed. zlib releases the GIL, so threads keep all cores busy."""
+        if len(segments) < 2:
+            for _, data in segments:
+                yield self.get(data, block_size)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=os.cpu_count()) as pool:
+            jobs = [pool.submit(self.get, data, block_size)
+                    for _, data in segments]
+            for job in jobs:
+                yield job.result()
+
+
+def md5_digests(segments):
+    """Returns an iterator of the md5 hex digests of (address, data)
+    segments, which are computed in the background"""
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    digests = pool.map(lambda segment: hashlib.md5(segment[1]).hexdigest(),
+                       segments)
+    pool.shutdown(wait=False)
+    return digests
+
+
+def region_digests(address, data, region_size):
+    """Yields (offset, length, md5) of data split into regions aligned to
+    absolute multiples of region_size"""
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        end = min(len(view),
+                  (address + offset) // region_size * region_size +
+                  region_size - address)
+        yield offset, end - offset, hashlib.md5(view[offset:end]).hexdigest()
+        offset = end
+
+
+def plan_writes(address, data, sector_size=0x1000, min_skip=0x10000):
+    """Splits a segment into ('write', offset, length) and ('erase', offset,
+    length) steps. Runs of at least min_skip bytes made of whole, aligned
+    sectors containing only 0xFF are erased instead of being written, which
+    leaves the same content on the board without programming them."""
+    view = memoryview(data)
+    erased = b'\xff' * sector_size
+    steps = []
+
+    def add(step, offset, length):
+        if steps and steps[-1][0] == step and sum(steps[-1][1:]) == offset:
+            steps[-1] = (step, steps[-1][1], steps[-1][2] + length)
+        else:
+            steps.append((step, offset, length))
+
+    # Leading bytes up to the first sector boundary are always written
+    offset = min(len(view), -address % sector_size)
+    if offset:
+        add('write', 0, offset)
+
+    run = None
+    while offset < len(view):
+        length = min(sector_size, len(view) - offset)
+        if length == sector_size and view[offset:offset + length] == erased:
+            run = offset if run is None else run
+        else:
+            if run is not None:
+                add('erase' if offset - run >= min_skip else 'write',
+                    run, offset - run)
+                run = None
+            add('write', offset, length)
+        offset += length
+
+    if run is not None:
+        add('erase' if offset - run >= min_skip else 'write',
+            run, offset - run)
+    return steps
+
+
+def plan_erase(regions, keep=(), size=None, sector_size=0x1000,
+               block_size=0x10000):
+    """Returns (address, length) erase steps covering all (address, length)
+    regions except the keep ranges, clipped to a flash of size bytes.
+    Regions are widened to whole sectors and merged. Each merged run is
+    split into leading sectors up to a block boundary, whole blocks and
+    trailing sectors, so the flash chip can use its block erase command for
+    the bulk of the run."""
+    ranges = []
+    for address, length in sorted(regions):
+        start = address // sector_size * sector_size
+        end = -(-(address + length) // sector_size) * sector_size
+        if size is not None:
+            end = min(end, size)
+        if start >= end:
+            continue
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+
+    for address, length in keep:
+        start = address // sector_size * sector_size
+        end = -(-(address + length) // sector_size) * sector_size
+        remaining = []
+        for a, b in ranges:
+            if a < start:
+                remaining.append([a, min(b, start)])
+            if b > end:
+                remaining.append([max(a, end), b])
+        ranges = remaining
+
+    steps = []
+    for start, end in ranges:
+        first = min(end, -(-start // block_size) * block_size)
+        last = max(first, end // block_size * block_size)
+        for a, b in ((start, first), (first, last), (last, end)):
+            if a < b:
+                steps.append((a, b - a))
+    return steps
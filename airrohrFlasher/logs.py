@@ -0,0 +1,396 @@
+"""Remote log messages broadcast by decoders"""
+
+import collections
+import concurrent.futures
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from .utils import write_json
+
+# A single log line: receive time (epoch seconds), sender IP, text and, for
+# syslog formatted lines, severity (0 emergency ... 7 debug) and tag
+LogEntry = collections.namedtuple('LogEntry',
+                                  'time address message severity tag',
+                                  defaults=(None, ''))
+
+SEVERITIES = ('emerg', 'alert', 'crit', 'err', 'warning', 'notice', 'info',
+              'debug')
+
+# <PRI> followed by either a RFC 5424 header (version, timestamp, host, app,
+# procid, msgid, structured data) or an optional RFC 3164 timestamp and host
+# and a "tag[pid]:" prefix
+_syslog_re = re.compile(
+    r'<(?P<pri>\d{1,3})>'
+    r'(?:1 \S+ \S+ (?P<app>\S+) \S+ \S+ (?:-|(?:\[.*?\])+) ?'
+    r'|(?:[A-Z][a-z]{2} [ \d]\d \d\d:\d\d:\d\d \S+ )?'
+    r'(?:(?P<tag>[^:\[\s]{1,48})(?:\[\d+\])?: ?)?)')
+
+
+def parse_syslog(when, address, text):
+    """Returns text received from address as LogEntry, filling in severity
+    and tag when it starts with a syslog header. Other text is kept as it
+    is."""
+    match = _syslog_re.match(text)
+    if not match or int(match.group('pri')) > 191:
+        return LogEntry(when, address, text)
+    tag = match.group('app') or match.group('tag') or ''
+    if tag == '-':
+        tag = ''
+    return LogEntry(when, address, text[match.end():],
+                    int(match.group('pri')) % 8, tag)
+
+_unescape_re = re.compile(r'\\(.)')
+_unescapes = {'t': '\t', 'n': '\n', 'r': '\r'}
+
+
+def _escape(text):
+    return (text.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def _unescape(text):
+    return _unescape_re.sub(
+        lambda m: _unescapes.get(m.group(1), m.group(1)), text)
+
+
+def _format(entry):
+    severity = '' if entry.severity is None else entry.severity
+    return '%.3f\t%s\t%s\t%s\t%s\n' % (entry.time, entry.address, severity,
+                                      _escape(entry.tag),
+                                      _escape(entry.message))
+
+
+def _parse(line):
+    fields = line.rstrip('\n').split('\t')
+    if len(fields) == 3:
+        # Written before severity and tag were stored
+        t, address, message = fields
+        return LogEntry(float(t), address, _unescape(message))
+    t, address, severity, tag, message = fields
+    return LogEntry(float(t), address, _unescape(message),
+                    int(severity) if severity else None, _unescape(tag))
+
+
+def severity_name(severity):
+    return '' if severity is None else SEVERITIES[severity]
+
+
+def format_entry(entry):
+    """Returns entry as a line for exported log files"""
+    stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry.time))
+    return '%s.%03d\t%s\t%s\t%s\t%s\n' % (
+        stamp, int(entry.time * 1000) % 1000, entry.address,
+        severity_name(entry.severity), entry.tag, entry.message)
+
+
+class LogIngest(object):
+    """Decides in the listener thread which log lines go on. Every sender
+    gets a token bucket refilled with `rate` lines per second holding up to
+    `burst` lines; lines beyond that are dropped and counted per sender, so
+    a decoder stuck in a reboot loop cannot drown the others. visible()
+    then removes muted senders and lines less severe than max_severity
+    before they are handed to the GUI. A rate of 0 disables the limit.
+    Senders quiet for idle_timeout seconds are forgotten together with
+    their drop count; their bucket would be full again anyway."""
+
+    idle_timeout = 300
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.muted = frozenset()
+        self.max_severity = len(SEVERITIES) - 1
+        self.buckets = {}
+        self.dropped = collections.Counter()
+        self.swept = time.time()
+        self.lock = threading.Lock()
+
+    def configure(self, muted=None, max_severity=None, rate=None):
+        with self.lock:
+            if muted is not None:
+                self.muted = frozenset(muted)
+            if max_severity is not None:
+                self.max_severity = max_severity
+            if rate is not None:
+                self.rate = rate
+
+    def limit(self, entries):
+        """Returns the entries within the rate limit of their sender"""
+        accepted = []
+        with self.lock:
+            if not self.rate:
+                return list(entries)
+            for entry in entries:
+                bucket = self.buckets.get(entry.address)
+                if bucket is None:
+                    bucket = self.buckets[entry.address] = [self.burst,
+                                                            entry.time]
+                tokens = min(self.burst, bucket[0] +
+                             (entry.time - bucket[1]) * self.rate)
+                bucket[1] = entry.time
+                if tokens < 1:
+                    bucket[0] = tokens
+                    self.dropped[entry.address] += 1
+                    continue
+                bucket[0] = tokens - 1
+                accepted.append(entry)
+            self._sweep()
+        return accepted
+
+    def _sweep(self):
+        """Drops idle senders, at most every idle_timeout seconds"""
+        now = time.time()
+        if now - self.swept < self.idle_timeout:
+            return
+        self.swept = now
+        for address in [a for a, bucket in self.buckets.items()
+                        if now - bucket[1] >= self.idle_timeout]:
+            del self.buckets[address]
+            self.dropped.pop(address, None)
+
+    def visible(self, entries):
+        """Returns the entries passing the sender and severity filters"""
+        with self.lock:
+            muted, max_severity = self.muted, self.max_severity
+        return [e for e in entries if e.address not in muted and
+                (e.severity is None or e.severity <= max_severity)]
+
+    def drop_counts(self):
+        """Returns {address: lines dropped by the rate limit}"""
+        with self.lock:
+            return dict(self.dropped)
+
+
+class LogStore(object):
+    """Keeps received log lines on disk. Lines are appended to a plain text
+    segment; once it exceeds `segment_size` bytes it is recorded in
+    index.json together with its time range and the addresses of all
+    senders, so queries only open segments that can match, and gzip
+    compressed on a background thread, so appending never waits for it.
+    The oldest segments are deleted when all of them exceed `max_size`
+    bytes."""
+
+    def __init__(self, path, segment_size, max_size):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.index_fname = os.path.join(path, 'index.json')
+        self.active_fname = os.path.join(path, 'active.log')
+
+        os.makedirs(path, exist_ok=True)
+        self.compressor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.segments = self._load_index()
+        self.meta = self._scan_active()
+        self.active = open(self.active_fname, 'a', encoding='utf-8',
+                           newline='\n')
+
+        # Segments a previous run did not get to compress
+        for segment in self.segments:
+            if not segment['file'].endswith('.gz'):
+                self.compressor.submit(self._compress, segment)
+
+    def _load_index(self):
+        try:
+            with open(self.index_fname) as fd:
+                return json.load(fd)['segments']
+        except (OSError, ValueError, KeyError):
+            return []
+
+    def _save_index(self):
+        write_json(self.index_fname, {'segments': self.segments})
+
+    @staticmethod
+    def _empty_meta():
+        return {'start': None, 'end': None, 'count': 0, 'addresses': set()}
+
+    def _scan_active(self):
+        """Rebuilds the metadata of the active segment left by a previous
+        run"""
+        meta = self._empty_meta()
+        try:
+            with open(self.active_fname, encoding='utf-8',
+                      errors='replace') as fd:
+                for line in fd:
+                    try:
+                        self._account(meta, _parse(line))
+                    except ValueError:
+                        pass
+        except OSError:
+            pass
+        return meta
+
+    @staticmethod
+    def _account(meta, entry):
+        if meta['start'] is None:
+            meta['start'] = entry.time
+        meta['end'] = entry.time
+        meta['count'] += 1
+        meta['addresses'].add(entry.address)
+
+    def append(self, entries):
+        with self.lock:
+            if self.active.closed:
+                # Lines still arriving after close()
+                return
+            for entry in entries:
+                self.active.write(_format(entry))
+                self._account(self.meta, entry)
+            self.active.flush()
+            if self.active.tell() >= self.segment_size:
+                self._rotate()
+
+    def _rotate(self):
+        """Starts a new active segment and hands the full one to the
+        compressor. Called with the lock held."""
+        self.active.close()
+        meta, self.meta = self.meta, self._empty_meta()
+        if meta['start'] is not None:
+            fname = 'segment-%d-%d.log' % (meta['start'] * 1000,
+                                           len(self.segments))
+            os.replace(self.active_fname, os.path.join(self.path, fname))
+            segment = {
+                'file': fname,
+                'start': meta['start'],
+                'end': meta['end'],
+                'count': meta['count'],
+                'addresses': sorted(meta['addresses']),
+                'size': os.path.getsize(os.path.join(self.path, fname)),
+            }
+            self.segments.append(segment)
+            self._save_index()
+            self.compressor.submit(self._compress, segment)
+        # else: nothing parseable in it (e.g. a damaged leftover), dropped
+
+        self.active = open(self.active_fname, 'w', encoding='utf-8',
+                           newline='\n')
+
+    def _compress(self, segment):
+        src = os.path.join(self.path, segment['file'])
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.path)
+            os.close(fd)
+            with open(src, 'rb') as fin, gzip.open(tmp, 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+            os.replace(tmp, src + '.gz')
+        except OSError as exc:
+            logging.warning('Compressing %s failed: %s', src, exc)
+            return
+
+        with self.lock:
+            segment['file'] += '.gz'
+            segment['size'] = os.path.getsize(src + '.gz')
+            self._evict()
+            self._save_index()
+        try:
+            os.unlink(src)
+        except OSError:
+            pass
+
+    def _evict(self):
+        while (len(self.segments) > 1 and
+               sum(s['size'] for s in self.segments) > self.max_size):
+            old = self.segments.pop(0)
+            try:
+                os.unlink(os.path.join(self.path, old['file']))
+            except OSError:
+                pass
+
+    @staticmethod
+    def _matches(segment, since, until, address):
+        if segment['start'] is None:
+            return False
+        if since is not None and segment['end'] < since:
+            return False
+        if until is not None and segment['start'] > until:
+            return False
+        return address is None or address in segment['addresses']
+
+    def query(self, since=None, until=None, address=None, text=None):
+        """Yields the LogEntry objects received between since and until
+        (epoch seconds) from address whose message contains text (case
+        insensitive), oldest first. Any criterion may be None. Segments are
+        read one line at a time, so memory use does not depend on the size
+        of the store."""
+        with self.lock:
+            segments = [dict(s) for s in self.segments]
+            self.active.flush()
+            active = dict(self.meta)
+
+        needle = text.lower() if text else None
+        for segment in segments:
+            if not self._matches(segment, since, until, address):
+                continue
+            fd = self._open(segment['file'])
+            if fd is None:
+                continue
+            with fd:
+                for entry in self._filter(fd, since, until, address, needle):
+                    yield entry
+
+        if self._matches(active, since, until, address):
+            # The active segment is small, read it at once so it cannot be
+            # rotated away while the caller consumes the results
+            with self.lock:
+                self.active.flush()
+                with open(self.active_fname, encoding='utf-8',
+                          errors='replace') as fd:
+                    lines = fd.readlines()
+            for entry in self._filter(lines, since, until, address, needle):
+                yield entry
+
+    def _open(self, fname):
+        """Opens a segment as text, None if it is gone. A segment still
+        being compressed may have been replaced by its .gz file since it
+        was looked up."""
+        if not fname.endswith('.gz'):
+            try:
+                return open(os.path.join(self.path, fname), encoding='utf-8',
+                            errors='replace')
+            except OSError:
+                fname += '.gz'
+        try:
+            return gzip.open(os.path.join(self.path, fname), 'rt',
+                             encoding='utf-8', errors='replace')
+        except OSError:
+            return None
+
+    @staticmethod
+    def _filter(lines, since, until, address, needle):
+        for line in lines:
+            try:
+                entry = _parse(line)
+            except ValueError:
+                logging.debug('Skipping damaged log line %r', line)
+                continue
+            if needle and needle not in entry.message.lower():
+                continue
+            if since is not None and entry.time < since:
+                continue
+            if until is not None and entry.time > until:
+                break
+            if address is not None and entry.address != address:
+                continue
+            yield entry
+
+    def export(self, fname, **query):
+        """Writes all entries matching query (see query()) to fname and
+        returns their number"""
+        count = 0
+        with open(fname, 'w', encoding='utf-8') as fd:
+            for entry in self.query(**query):
+                fd.write(format_entry(entry))
+                count += 1
+        return count
+
+    def close(self):
+        self.compressor.shutdown(wait=True)
+        with self.lock:
+            self.active.close()
@@ -0,0 +1,299 @@
+"""Item models backing the tables of the main window"""
+
+import time
+
+from .qtvariant import QtCore, QtGui
+from .consts import ROLE_DEVICE, DATA_ADDR, DATA_NAME, DATA_INFO, DATA_ONLINE
+from .logs import severity_name
+from .utils import translator
+
+
+_translate = translator('DeviceTableModel')
+
+
+class Device(object):
+    """A row of the discovery list"""
+    __slots__ = ('key', 'typ', 'address', 'name', 'label', 'version', 'info',
+                 'online', 'status', 'removed')
+
+    def __init__(self, key, typ, address, name, label, version='',
+                 info=None):
+        self.key = key
+        self.typ = typ
+        self.address = address
+        self.name = name
+        self.label = label
+        self.version = version
+        self.info = info
+        self.online = True
+        self.status = ''
+        self.removed = False
+
+
+class DeviceTableModel(QtCore.QAbstractTableModel):
+    """USB and network decoders keyed by their identity (port_key() of USB
+    boards, service name of zeroconf devices). Adding or updating a device
+    only touches its own row. Devices that disappear are kept and shown as
+    offline until remove_offline() is called, so a decoder rebooting after
+    an update keeps its row and selection. Removed devices are only marked
+    and hidden by DeviceFilterProxyModel; their rows are dropped in one go
+    once they make up half of the model, so removal costs O(1) amortized
+    instead of renumbering all following rows every time."""
+
+    COLUMNS = ('address', 'label', 'version', 'status')
+    HEADERS = ('Address', 'Name', 'Version', 'Status')
+
+    def __init__(self, parent=None):
+        super(DeviceTableModel, self).__init__(parent)
+        self.devices = []
+        self.rows = {}
+        self.by_address = {}
+        self.removed = 0
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.devices)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if (role == QtCore.Qt.DisplayRole and
+                orientation == QtCore.Qt.Horizontal):
+            return _translate(self.HEADERS[section])
+        return None
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        device = self.devices[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return getattr(device, self.COLUMNS[index.column()]) or ''
+        if role == QtCore.Qt.ForegroundRole and not device.online:
+            return QtGui.QBrush(QtCore.Qt.gray)
+        if role == ROLE_DEVICE:
+            return device.typ
+        if role == DATA_ADDR:
+            return device.address
+        if role == DATA_NAME:
+            return device.name
+        if role == DATA_INFO:
+            return device.info
+        if role == DATA_ONLINE:
+            return device.online
+        return None
+
+    def _changed(self, row):
+        self.dataChanged.emit(self.index(row, 0),
+                              self.index(row, len(self.COLUMNS) - 1))
+
+    def upsert(self, key, typ, address, name, label, version='', info=None):
+        """Adds a device or updates the row of a known one, which is then
+        online again"""
+        row = self.rows.get(key)
+        if row is None:
+            row = len(self.devices)
+            self.beginInsertRows(QtCore.QModelIndex(), row, row)
+            self.devices.append(
+                Device(key, typ, address, name, label, version, info))
+            self.rows[key] = row
+            self.by_address[address] = key
+            self.endInsertRows()
+            return
+
+        device = self.devices[row]
+        if device.removed:
+            device.removed = False
+            self.removed -= 1
+        elif device.address != address and \
+                self.by_address.get(device.address) == key:
+            del self.by_address[device.address]
+        self.by_address[address] = key
+        device.typ = typ
+        device.address = address
+        device.name = name
+        device.label = label
+        device.version = version
+        device.info = info
+        device.online = True
+        self._changed(row)
+
+    def set_online(self, key, online):
+        row = self.rows.get(key)
+        if row is not None and self.devices[row].online != online:
+            self.devices[row].online = online
+            self._changed(row)
+
+    def set_typ_online(self, typ, online):
+        """Marks all devices of one transport as online or offline"""
+        for device in self.devices:
+            if device.typ == typ and not device.removed:
+                device.online = online
+        if self.devices:
+            self.dataChanged.emit(
+                self.index(0, 0),
+                self.index(len(self.devices) - 1, len(self.COLUMNS) - 1))
+
+    def set_status(self, address, status):
+        """Shows a progress message next to the device at address"""
+        row = self.rows.get(self.by_address.get(address))
+        if row is not None:
+            self.devices[row].status = status
+            self._changed(row)
+
+    def remove(self, key):
+        self._remove(key)
+        self._compact()
+
+    def remove_offline(self):
+        """Drops all offline devices"""
+        for device in self.devices:
+            if not device.online:
+                self._remove(device.key)
+        self._compact()
+
+    def _remove(self, key):
+        row = self.rows.get(key)
+        if row is None or self.devices[row].removed:
+            return
+        device = self.devices[row]
+        device.removed = True
+        self.removed += 1
+        if self.by_address.get(device.address) == key:
+            del self.by_address[device.address]
+        self._changed(row)
+
+    def _compact(self):
+        """Drops the rows of removed devices once they are half of all
+        rows, renumbering the remaining ones once"""
+        if not self.removed or self.removed * 2 < len(self.devices):
+            return
+        row = len(self.devices)
+        while row > 0:
+            row -= 1
+            if not self.devices[row].removed:
+                continue
+            last = row
+            while row > 0 and self.devices[row - 1].removed:
+                row -= 1
+            self.beginRemoveRows(QtCore.QModelIndex(), row, last)
+            for device in self.devices[row:last + 1]:
+                del self.rows[device.key]
+            del self.devices[row:last + 1]
+            self.endRemoveRows()
+        self.removed = 0
+        for row, device in enumerate(self.devices):
+            self.rows[device.key] = row
+
+    def any_online(self, typ):
+        return any(d.online and d.typ == typ and not d.removed
+                   for d in self.devices)
+
+
+class DeviceFilterProxyModel(QtCore.QSortFilterProxyModel):
+    """Sorts the discovery list and filters it by a search text matched
+    against address, name and version, by transport and by online state"""
+
+    def __init__(self, parent=None):
+        super(DeviceFilterProxyModel, self).__init__(parent)
+        self.text = ''
+        self.typ = None
+        self.online_only = False
+        self.setDynamicSortFilter(True)
+        self.setSortCaseSensitivity(QtCore.Qt.CaseInsensitive)
+
+    def set_text(self, text):
+        self.text = text.strip().lower()
+        self.invalidateFilter()
+
+    def set_typ(self, typ):
+        self.typ = typ
+        self.invalidateFilter()
+
+    def set_online_only(self, online_only):
+        self.online_only = online_only
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, row, parent):
+        device = self.sourceModel().devices[row]
+        if device.removed:
+            return False
+        if self.typ is not None and device.typ != self.typ:
+            return False
+        if self.online_only and not device.online:
+            return False
+        if self.text:
+            return any(self.text in (value or '').lower() for value in
+                       (device.address, device.label, device.version))
+        return True
+
+
+class LogTableModel(QtCore.QAbstractTableModel):
+    """The last `capacity` log entries, newest first. Entries live in a
+    fixed size ring buffer, so adding a batch costs the same no matter how
+    many lines have been received before, and memory stays bounded."""
+
+    HEADERS = ('Zeit', 'IP', 'Level', 'Tag', 'Message')
+
+    def __init__(self, capacity, parent=None):
+        super(LogTableModel, self).__init__(parent)
+        self.capacity = capacity
+        self.buffer = [None] * capacity
+        self.head = 0
+        self.count = 0
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else self.count
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if (role == QtCore.Qt.DisplayRole and
+                orientation == QtCore.Qt.Horizontal):
+            return self.HEADERS[section]
+        return None
+
+    def entry(self, row):
+        return self.buffer[(self.head - 1 - row) % self.capacity]
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or role != QtCore.Qt.DisplayRole:
+            return None
+        entry = self.entry(index.row())
+        column = index.column()
+        if column == 0:
+            return time.strftime('%H:%M:%S', time.localtime(entry.time))
+        if column == 1:
+            return entry.address
+        if column == 2:
+            return severity_name(entry.severity)
+        if column == 3:
+            return entry.tag
+        return entry.message
+
+    def extend(self, entries):
+        """Adds a batch of entries on top, dropping the oldest ones beyond
+        capacity"""
+        entries = entries[-self.capacity:]
+        if not entries:
+            return
+
+        overflow = self.count + len(entries) - self.capacity
+        if overflow > 0:
+            self.beginRemoveRows(QtCore.QModelIndex(),
+                                 self.count - overflow, self.count - 1)
+            self.count -= overflow
+            self.endRemoveRows()
+
+        self.beginInsertRows(QtCore.QModelIndex(), 0, len(entries) - 1)
+        for entry in entries:
+            self.buffer[self.head] = entry
+            self.head = (self.head + 1) % self.capacity
+        self.count += len(entries)
+        self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.buffer = [None] * self.capacity
+        self.head = self.count = 0
+        self.endResetModel()
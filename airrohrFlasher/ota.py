@@ -0,0 +1,126 @@
+"""Over-the-air firmware updates of decoders found on the network"""
+
+import os
+import re
+import time
+import uuid
+
+import requests
+from requests.auth import HTTPBasicAuth
+
+
+class OtaError(Exception):
+    def __init__(self, code, text):
+        super(OtaError, self).__init__('Error {} : {}'.format(code, text))
+        self.code = code
+        self.text = text
+
+
+def upload_field(info):
+    """Returns the multipart field name expected by the device's updater,
+    as announced by the FlashModus TXT record"""
+    flashModus = b''
+    if info and b'FlashModus' in info.properties:
+        flashModus = info.properties.get(b'FlashModus') or b''
+
+    if (flashModus == b"Arduino_Esp8266_2.6"):
+        return 'firmware'
+    # Arduino_Esp8266_2.5 and devices without FlashModus
+    return 'file'
+
+
+class MultipartEncoder(object):
+    """File-like multipart/form-data body with a single file field. The file
+    (a path or a bytes-like object, which is never copied) is read chunk by
+    chunk while requests sends the body, and progress(sent, total, rate) is
+    called for every chunk. Each upload needs its own encoder."""
+
+    def __init__(self, field, filename, source, progress=None):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + self.boundary
+        self.progress = progress
+
+        self.head = ('--{}\r\nContent-Disposition: form-data; name="{}"; '
+                     'filename="{}"\r\nContent-Type: application/octet-stream'
+                     '\r\n\r\n').format(self.boundary, field, filename).encode('utf-8')
+        self.tail = '\r\n--{}--\r\n'.format(self.boundary).encode('utf-8')
+
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            self.fd = None
+            self.data = memoryview(source)
+            self.size = len(self.data)
+        else:
+            self.fd = open(source, 'rb')
+            self.data = None
+            self.size = os.fstat(self.fd.fileno()).st_size
+
+        self.total = len(self.head) + self.size + len(self.tail)
+        self.sent = 0
+        self.started = None
+
+    def __len__(self):
+        return self.total - self.sent
+
+    def read(self, size=-1):
+        if self.started is None:
+            self.started = time.time()
+        if size is None or size < 0:
+            size = self.total - self.sent
+
+        chunk = b''
+        while len(chunk) < size and self.sent < self.total:
+            chunk += self._part(size - len(chunk))
+
+        if chunk and self.progress:
+            rate = self.sent / max(time.time() - self.started, 1e-3)
+            self.progress(self.sent, self.total, rate)
+        if self.sent >= self.total:
+            self.close()
+        return chunk
+
+    def _part(self, size):
+        pos = self.sent
+        if pos < len(self.head):
+            part = self.head[pos:pos + size]
+        elif pos < len(self.head) + self.size:
+            pos -= len(self.head)
+            if self.data is not None:
+                part = bytes(self.data[pos:pos + size])
+            else:
+                part = self.fd.read(min(size, self.size - pos))
+                if not part:
+                    raise IOError('File shrank during upload')
+        else:
+            pos -= len(self.head) + self.size
+            part = self.tail[pos:pos + size]
+        self.sent += len(part)
+        return part
+
+    def close(self):
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+
+
+def post_file(url, field, filename, source, progress=None, timeout=120,
+              **kwargs):
+    """Streams source as multipart file field to url"""
+    body = MultipartEncoder(field, filename, source, progress)
+    try:
+        return requests.post(url, data=body, timeout=timeout,
+                             headers={'Content-Type': body.content_type},
+                             **kwargs)
+    finally:
+        body.close()
+
+
+def upload_firmware(address, image, field, progress=None, timeout=120):
+    """Streams a firmware image (path or bytes) to the device and returns
+    its answer without HTML tags. Raises OtaError when the device rejects
+    the image."""
+    url = "http://" + address + "/firmware"
+    r = post_file(url, field, 'firmware.bin', image, progress, timeout,
+                  auth=HTTPBasicAuth('admin', 'admin'))
+    if (r.status_code != 200):
+        raise OtaError(r.status_code, r.text)
+    return re.sub('<.*?>', '', r.text)
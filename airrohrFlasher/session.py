@@ -0,0 +1,136 @@
+"""Stub sessions kept open across operations on a board"""
+
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+
+class SessionManager(object):
+    """Keeps one connected, stub loaded ESPLoader per serial port.
+
+    Jobs for a port are queued and run one after another on a worker
+    thread owning that port, so an erase, flash and verify in a row only
+    connect (reset the board, upload the stub, negotiate the baud rate)
+    once, while different ports work in parallel. A session that has been
+    idle for idle_timeout seconds is closed with a hard reset, which starts
+    the firmware on the board. connect(device, progress) must return a stub
+    ESPLoader."""
+
+    def __init__(self, connect, idle_timeout):
+        self.connect = connect
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.sessions = {}
+        self.last_used = {}
+        self.queued = collections.Counter()
+        self.stopped = threading.Event()
+        threading.Thread(target=self._janitor, daemon=True).start()
+
+    def _submit(self, device, func, *args):
+        with self.lock:
+            queue = self.queues.get(device)
+            if queue is None:
+                queue = self.queues[device] = \
+                    concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            self.queued[device] += 1
+        return queue.submit(self._call, device, func, *args)
+
+    def _call(self, device, func, *args):
+        try:
+            return func(device, *args)
+        finally:
+            with self.lock:
+                self.queued[device] -= 1
+
+    def submit(self, device, job, progress):
+        """Queues job(esp) for the board at device and returns a Future of
+        its result"""
+        return self._submit(device, self._run, job, progress)
+
+    def run(self, device, job, progress):
+        """Runs job(esp) on the board at device and returns its result"""
+        return self.submit(device, job, progress).result()
+
+    def busy(self, device):
+        with self.lock:
+            return self.queued[device] > 0
+
+    def busy_devices(self):
+        with self.lock:
+            return [device for device, count in self.queued.items() if count]
+
+    def _run(self, device, job, progress):
+        esp = self.sessions.get(device)
+        if esp is not None and not self._alive(esp):
+            logging.info('Session on %s lost, reconnecting', device)
+            self._close(device, reset=False)
+            esp = None
+        if esp is None:
+            esp = self.sessions[device] = self.connect(device, progress)
+
+        try:
+            return job(esp)
+        except Exception:
+            # The state of the stub is unknown after a failed job
+            self._close(device, reset=False)
+            raise
+        finally:
+            self.last_used[device] = time.time()
+
+    @staticmethod
+    def _alive(esp):
+        try:
+            esp.read_reg(esp.CHIP_DETECT_MAGIC_REG_ADDR)
+            return True
+        except Exception:
+            return False
+
+    def _close(self, device, reset=True):
+        esp = self.sessions.pop(device, None)
+        if esp is None:
+            return
+        if reset:
+            try:
+                esp.hard_reset()
+            except Exception as exc:
+                logging.info('Resetting %s failed: %s', device, exc)
+        try:
+            esp._port.close()
+        except Exception:
+            pass
+
+    def _close_idle(self, device):
+        if time.time() - self.last_used.get(device, 0) >= self.idle_timeout:
+            self._close(device)
+
+    def close(self, device):
+        """Closes the session of device once its queued jobs are done,
+        resetting the board. Returns a Future, which is already done when
+        there is nothing to close."""
+        with self.lock:
+            idle = device not in self.sessions and not self.queued[device]
+        if idle:
+            future = concurrent.futures.Future()
+            future.set_result(None)
+            return future
+        return self._submit(device, self._close)
+
+    def close_all(self, wait=True):
+        """Closes all sessions once their jobs are done. Without wait the
+        boards are reset in the background."""
+        self.stopped.set()
+        jobs = [self.close(device) for device in list(self.sessions)]
+        if wait:
+            for job in jobs:
+                job.result()
+
+    def _janitor(self):
+        while not self.stopped.wait(1.0):
+            now = time.time()
+            for device in list(self.sessions):
+                if (now - self.last_used.get(device, now) >=
+                        self.idle_timeout and not self.busy(device)):
+                    self._submit(device, self._close_idle)
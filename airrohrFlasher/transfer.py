@@ -0,0 +1,201 @@
+"""File transfer to a decoder over its serial debug console"""
+
+import base64
+import contextlib
+import logging
+
+import serial
+
+from .utils import translator
+from .consts import TRANSFER_SEGMENT_SIZE, TRANSFER_WINDOW
+
+
+_translate = translator('SerialTransfer')
+
+
+class TransferError(Exception):
+    pass
+
+
+class SerialTransfer(object):
+    """Sends files with the firmware's PUT command over an open serial port.
+
+    The base64 encoded payload is split into segments, each acknowledged
+    with "SEGMENT OK" or "SEGMENT FAIL". Firmware that answers the "CAP"
+    query with "CAP WINDOW=<n> SEGMENT=<bytes>" gets up to n segments in
+    flight. Those segments are framed as "@<offset>,<length>:<data>" and
+    acknowledged with their offset, so a failed segment and everything sent
+    after it is simply sent again (go-back-n). Any other answer selects the
+    classic stop-and-wait transfer with fixed 500 byte segments. The query
+    is only sent when a window of 2 or more is requested."""
+
+    def __init__(self, ser, segment_size=TRANSFER_SEGMENT_SIZE,
+                 window=TRANSFER_WINDOW, max_errors=5):
+        self.ser = ser
+        self.requested_segment_size = segment_size
+        self.requested_window = window
+        self.max_errors = max_errors
+        self.segment_size = 500
+        self.max_window = 1
+        self.window = 1
+
+    def readline(self):
+        s = self.ser.readline().decode('utf-8', 'replace').rstrip('\r\n')
+        logging.debug('From ESP> %s', s)
+        return s
+
+    def enter(self):
+        """Switches the firmware into transfer mode"""
+        self.ser.write("xdebug".encode('utf-8'))
+        s = self.readline()
+        if (s != "Debugmodus aktiviert"):
+            s = self.readline()
+        if (s != "Debugmodus aktiviert"):
+            raise TransferError(_translate(
+                "Aktivierung des Debugmodus fehlgeschlagen!"))
+
+        self.ser.write("_".encode('utf-8'))
+        if (self.readline() != "TRANSFER ACTIVE"):
+            raise TransferError(_translate(
+                "Aktivierung des Transfers fehlgeschlagen!"))
+
+        if self.requested_window > 1:
+            self.negotiate()
+
+    def negotiate(self):
+        """Asks the firmware for windowed transfer support. Firmware without
+        it ignores the query, which costs one readline timeout (1 s) per
+        session."""
+        self.segment_size = 500
+        self.max_window = self.window = 1
+
+        self.ser.write(b"CAP\r\n")
+        s = self.readline()
+        if not s.startswith("CAP "):
+            logging.info('Firmware without windowed transfers, using '
+                         'stop-and-wait')
+            return
+
+        caps = dict(item.split('=', 1) for item in s.split()[1:]
+                    if '=' in item)
+        try:
+            window = min(self.requested_window, int(caps['WINDOW']))
+            segment_size = min(self.requested_segment_size,
+                               int(caps['SEGMENT']))
+        except (KeyError, ValueError):
+            return
+        self.segment_size = segment_size
+        self.max_window = self.window = max(1, window)
+
+    def leave(self):
+        """Leaves transfer mode"""
+        self.ser.write("x".encode('utf-8'))
+        self.readline()
+
+    def put(self, filename, content, progress=None):
+        """Stores content as filename on the device. progress(sent, total)
+        is called whenever a segment has been acknowledged."""
+        b64 = base64.b64encode(content)
+        s = "PUT " + str(len(b64)) + " " + filename + "\r\n"
+        self.ser.write(s.encode('iso-8859-1'))
+
+        if self.max_window > 1:
+            self._send_windowed(b64, progress)
+        else:
+            self._send_stop_and_wait(b64, progress)
+
+    def _send_stop_and_wait(self, b64, progress):
+        currentSegment = 0
+        while True:
+            self.ser.write(b64[currentSegment:currentSegment + self.segment_size])
+            self.ser.flush()
+            err = 0
+            while True:
+                s = self.readline()
+                if (s == ""):
+                    err = err + 1
+                if (err > self.max_errors):
+                    raise TransferError(_translate("ESP antwortet nicht"))
+                if (s.startswith("SEGMENT OK ")):
+                    currentSegment += self.segment_size
+                    if progress:
+                        progress(min(currentSegment, len(b64)), len(b64))
+                    break
+                if (s.startswith("SEGMENT FAIL ")):
+                    logging.info('Resending segment at %d', currentSegment)
+                    break
+                if (s.startswith("TRANSFER END")):
+                    return
+
+    def _send_windowed(self, b64, progress):
+        size = self.segment_size
+        offsets = list(range(0, len(b64), size)) or [0]
+        view = memoryview(b64)
+        base = 0       # first unacknowledged segment
+        following = 0  # next segment to send
+        acked = 0
+        err = 0
+
+        while True:
+            while (following < len(offsets) and
+                   following - base < self.window):
+                offset = offsets[following]
+                data = view[offset:offset + size]
+                self.ser.write(("@%d,%d:" % (offset, len(data))).encode('ascii'))
+                self.ser.write(data)
+                following += 1
+            self.ser.flush()
+
+            s = self.readline()
+            if (s == ""):
+                err = err + 1
+                if (err > self.max_errors):
+                    raise TransferError(_translate("ESP antwortet nicht"))
+                # Nothing heard back, assume the window got lost
+                following = base
+                self.window = 1
+                continue
+            err = 0
+
+            if (s.startswith("TRANSFER END")):
+                return
+
+            if not s.startswith(("SEGMENT OK ", "SEGMENT FAIL ")):
+                continue
+            try:
+                index = int(s.split()[2]) // size
+            except (IndexError, ValueError):
+                index = base
+
+            if (s.startswith("SEGMENT OK ")):
+                if index < base:
+                    continue
+                base = index + 1
+                following = max(following, base)
+                acked += 1
+                if acked % self.window == 0:
+                    self.window = min(self.max_window, self.window + 1)
+                if progress:
+                    progress(min(base * size, len(b64)), len(b64))
+            elif index < following:
+                logging.info('Resending from segment at %d', index * size)
+                base = following = max(base, index)
+                self.window = max(1, self.window // 2)
+
+
+@contextlib.contextmanager
+def transfer_session(device, baudrate=115200, **kwargs):
+    """Opens device and switches the firmware into transfer mode once, so
+    any number of files can be sent with put() back to back. Transfer mode
+    is left when the block completes, also when it fails."""
+    with serial.Serial(device, baudrate, timeout=1) as ser:
+        transfer = SerialTransfer(ser, **kwargs)
+        transfer.enter()
+        try:
+            yield transfer
+        finally:
+            try:
+                transfer.leave()
+            except (serial.SerialException, OSError) as exc:
+                # The port may be gone, keep the original error
+                logging.info('Leaving transfer mode failed: %s', exc)
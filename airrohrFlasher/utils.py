@@ -1,24 +1,69 @@
-import requests
 import re
 import logging
-import csv
+import os
+import tempfile
 import urllib
 import json
 from .qtvariant import QtCore
 import urllib.request
-from contextlib import closing
+from collections import OrderedDict
 
 
 #file_index_re = re.compile(r'<a href="([^"]*)">([^<]*)</a>')
 
 
-def indexof(url):
-    r = requests.get(url=url)
-    json = r.json()
-    data = [ [item['board'], item['version'], item['url']] for item in json['firmware']]
+def translator(context):
+    """Returns a function translating text in context, for module level
+    code without QObject.tr()"""
+    def translate(text):
+        return QtCore.QCoreApplication.translate(context, text)
+    return translate
+
+
+def write_json(fname, data, **kwargs):
+    """Stores data as JSON in fname. It is written to a temporary file
+    first, so a crash never leaves a partial file behind. kwargs are passed
+    on to json.dump()."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, **kwargs)
+        os.replace(tmp, fname)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def read_index(fname):
+    """Returns the firmware list stored in a flash.json file as list of
+    [board, version, url]"""
+    with open(fname) as fd:
+        index = json.load(fd)
+    data = [ [item['board'], item['version'], item['url']] for item in index['firmware']]
     return data
 
 
+class FirmwareIndex(object):
+    """Firmware lists of several repositories merged by (board, version).
+    For duplicates the entry of the repository listed first wins."""
+    def __init__(self, sources):
+        self.sources = list(sources)
+        self.lists = {}
+
+    def __bool__(self):
+        return bool(self.lists)
+
+    def update(self, source, entries):
+        self.lists[source] = entries
+
+    def entries(self):
+        merged = OrderedDict()
+        for source in self.sources:
+            for board, version, url in self.lists.get(source, []):
+                merged.setdefault((board, version), [board, version, url])
+        return list(merged.values())
+
+
 class QuickThread(QtCore.QThread):
     error = QtCore.Signal([str])
 
@@ -59,3 +104,15 @@ class QuickThread(QtCore.QThread):
 
     def target(self):
         pass
+
+
+class DeviceProgress(object):
+    """Forwards (status, progress) reports of a single board to a
+    (device, status, progress) signal, so code written against the plain
+    progress signal can be reused by per-board workers"""
+    def __init__(self, signal, device):
+        self.signal = signal
+        self.device = device
+
+    def emit(self, status, progress):
+        self.signal.emit(self.device, status, progress)
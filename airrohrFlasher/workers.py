@@ -1,81 +1,266 @@
 import time
 import socket
+import select
+import logging
+import collections
+import threading
+import concurrent.futures
 
 import serial
 import serial.tools.list_ports
 import zeroconf
+from zeroconf import ServiceStateChange
 import socket
 from .qtvariant import QtCore
-from .utils import indexof, QuickThread
-from .consts import UPDATE_REPOSITORY
+from .utils import read_index, FirmwareIndex, QuickThread
+from .hotplug import UeventMonitor, port_key, diff_ports
+from .logs import LogIngest, parse_syslog
+from .consts import UPDATE_REPOSITORIES, LOG_PORT, LOG_CAPACITY, \
+    LOG_RATE_LIMIT, LOG_BURST
 from typing import cast
 
 class PortDetectThread(QuickThread):
     interval = 1.0
-    portsUpdate = QtCore.Signal([list])
+    portsUpdate = QtCore.Signal(list, list)
     ports = None
 
     def target(self):
-        """Checks list of available ports and emits signal when necessary"""
-
+        """Emits portsUpdate with the lists of added and removed ports
+        whenever boards are plugged in or out. On Linux the thread sleeps
+        until the kernel reports a tty change, elsewhere the port list is
+        polled every interval seconds."""
+        monitor = UeventMonitor.create()
+        self.ports = {}
         while True:
-            new_ports = serial.tools.list_ports.comports()
-
-            if self.ports is None or [p.name for p in self.ports] != [p.name for p in new_ports]:
-                self.portsUpdate.emit(new_ports)
-
-            time.sleep(self.interval)
-
+            new_ports = {port_key(p): p
+                         for p in serial.tools.list_ports.comports()}
+            added, removed = diff_ports(self.ports, new_ports)
             self.ports = new_ports
+            if added or removed:
+                self.portsUpdate.emit(added, removed)
+
+            if monitor:
+                monitor.wait()
+            else:
+                time.sleep(self.interval)
 
     def restart(self):
-        if not self.ports is None:
-                self.portsUpdate.emit(self.ports)
+        """Emits all known ports as added again"""
+        if self.ports:
+            self.portsUpdate.emit(list(self.ports.values()), [])
 
 
 class FirmwareListThread(QuickThread):
     listLoaded = QtCore.Signal([list])
+    timeout = 10
 
-    def target(self):
-        """Downloads list of available firmware updates in separate thread."""
-        self.listLoaded.emit(list(indexof(UPDATE_REPOSITORY)))
+    def target(self, cache, sources=UPDATE_REPOSITORIES):
+        """Emits the merged list of available firmware updates of all
+        repositories. The last known lists are emitted at once, then all
+        repositories are revalidated concurrently with a conditional GET. The
+        list is emitted again whenever a repository has changed, so a slow
+        mirror never delays the others."""
+        index = FirmwareIndex(sources)
+        snapshots = {}
+        for url in sources:
+            snapshots[url] = cache.lookup(url)
+            if snapshots[url]:
+                index.update(url, read_index(snapshots[url]))
+        if index:
+            self.listLoaded.emit(index.entries())
+
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(sources)) as pool:
+            jobs = {pool.submit(cache.fetch, url, timeout=self.timeout): url
+                    for url in sources}
+            for job in concurrent.futures.as_completed(jobs):
+                url = jobs[job]
+                try:
+                    current = job.result()
+                except Exception as exc:
+                    logging.warning('Loading firmware list %s failed: %s',
+                                    url, exc)
+                    failed.append(exc)
+                    continue
+                if current != snapshots[url]:
+                    index.update(url, read_index(current))
+                    self.listLoaded.emit(index.entries())
+
+        if failed and not index:
+            raise failed[0]
 
 
 class ZeroconfDiscoveryThread(QuickThread):
-    deviceDiscovered = QtCore.Signal(str, str, object)
+    deviceAdded = QtCore.Signal(str, str, object)
+    deviceUpdated = QtCore.Signal(str, str, object)
+    deviceRemoved = QtCore.Signal(str)
+    prefix = 'ly-dcc-'
+    ttl = 120
+    resolve_timeout = 3000
+    workers = 8
     browser = None
 
+    def __init__(self, *args, **kwargs):
+        super(ZeroconfDiscoveryThread, self).__init__(*args, **kwargs)
+        self.registry = {}
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
     def target(self):
-        """This thread scans for Bonjour/mDNS devices and emits
-        deviceDiscovered signal with its name, address and info object"""
+        """This thread keeps a registry of the decoders announced via
+        Bonjour/mDNS, keyed by service name. Services are resolved in a
+        thread pool so a slow one never blocks the browser. Entries not
+        confirmed within ttl seconds are resolved again and dropped when
+        that fails. Only changes are emitted: deviceAdded and
+        deviceUpdated with name, address and info object, deviceRemoved
+        with the name."""
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers)
         self.zc = zeroconf.Zeroconf()
-        self.browser = zeroconf.ServiceBrowser(
-            self.zc, "_http._tcp.local.", handlers=[self.on_state_change])
-        while True:
-            time.sleep(0.5)
+        self.browser = None
+        try:
+            self.browser = zeroconf.ServiceBrowser(
+                self.zc, "_http._tcp.local.", handlers=[self.on_state_change])
+            while not self.stopped.wait(self.ttl / 4):
+                self.expire()
+        finally:
+            if self.browser:
+                self.browser.cancel()
+            self.pool.shutdown(wait=True)
+            self.zc.close()
 
     def on_state_change(self, zeroconf, service_type, name, state_change):
-        info = zeroconf.get_service_info(service_type, name)
-        if info:
-            for addr in info.parsed_addresses():
-             print("  Addresses: %s" % (addr))
-             self.deviceDiscovered.emit(name, addr, info)
+        # Other devices on the network are not even resolved
+        if not name.lower().startswith(self.prefix):
+            return
+        if state_change is ServiceStateChange.Removed:
+            self.remove(name)
+        else:
+            self.resolve(service_type, name)
+
+    def resolve(self, service_type, name):
+        with self.lock:
+            if name in self.pending or self.stopped.is_set():
+                return
+            self.pending.add(name)
+        try:
+            self.pool.submit(self._resolve, service_type, name)
+        except RuntimeError:
+            # Pool has been shut down meanwhile
+            with self.lock:
+                self.pending.discard(name)
+
+    def _resolve(self, service_type, name):
+        try:
+            info = self.zc.get_service_info(service_type, name,
+                                            self.resolve_timeout)
+        except Exception as exc:
+            logging.warning('Resolving %s failed: %s', name, exc)
+            info = None
+        finally:
+            with self.lock:
+                self.pending.discard(name)
+
+        addresses = info.parsed_addresses() if info else []
+        if not addresses:
+            self.remove(name)
+            return
+
+        with self.lock:
+            old = self.registry.get(name)
+            self.registry[name] = {
+                'type': service_type,
+                'address': addresses[0],
+                'info': info,
+                'expires': time.time() + self.ttl,
+            }
+        if old is None:
+            self.deviceAdded.emit(name, addresses[0], info)
+        elif (old['address'] != addresses[0] or
+              old['info'].properties != info.properties):
+            self.deviceUpdated.emit(name, addresses[0], info)
+
+    def remove(self, name):
+        with self.lock:
+            known = self.registry.pop(name, None)
+        if known:
+            self.deviceRemoved.emit(name)
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            expired = [(entry['type'], name)
+                       for name, entry in self.registry.items()
+                       if entry['expires'] < now]
+        for service_type, name in expired:
+            self.resolve(service_type, name)
 
     def stop(self):
-        if self.browser:
-            self.browser.cancel()
+        self.stopped.set()
 
 
 
 class LogListenerThread(QuickThread):
-    logReceived = QtCore.Signal(str, str)
-#    deviceDiscovered = QtCore.Signal(str, str, object)
-    #browser = None
+    batch_size = 256
+    receive_buffer = 1024 * 1024
 
-    def target(self):
+    def __init__(self, *args, **kwargs):
+        super(LogListenerThread, self).__init__(*args, **kwargs)
+        self.pending = collections.deque(maxlen=LOG_CAPACITY)
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.ingest = LogIngest(LOG_RATE_LIMIT, LOG_BURST)
+
+    def target(self, store=None, port=LOG_PORT):
+        """Receives log datagrams and queues them as LogEntry objects. The
+        socket is drained in batches of up to batch_size datagrams, the GUI
+        collects them with take() at its own pace. When it falls behind the
+        oldest pending lines are dropped instead of growing the queue.
+
+        Syslog headers are parsed here and self.ingest applies the per
+        sender rate limit. The remaining lines are appended to the LogStore
+        store, if given, and only those passing the sender and severity
+        filters are queued for the GUI."""
         serverSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        serverSock.bind(("0.0.0.0", 5514))
+        try:
+            serverSock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                  self.receive_buffer)
+        except OSError:
+            pass
+        serverSock.bind(("0.0.0.0", port))
+        serverSock.setblocking(False)
+
         while True:
-                data, addr = serverSock.recvfrom(1024) # buffer size is 1024 bytes   
-                self.logReceived.emit(data.decode("utf-8"), addr[0])
+            select.select([serverSock], [], [])
+            now = time.time()
+            batch = []
+            for _ in range(self.batch_size):
+                try:
+                    data, addr = serverSock.recvfrom(2048)
+                except (BlockingIOError, InterruptedError):
+                    break
+                batch.append(parse_syslog(now, addr[0], data.decode(
+                    'utf-8', 'replace').rstrip('\r\n')))
+
+            batch = self.ingest.limit(batch)
+            if store and batch:
+                try:
+                    store.append(batch)
+                except OSError as exc:
+                    logging.warning('Storing log lines failed: %s', exc)
+
+            batch = self.ingest.visible(batch)
+            with self.lock:
+                overflow = len(self.pending) + len(batch) - LOG_CAPACITY
+                if overflow > 0:
+                    self.dropped += overflow
+                self.pending.extend(batch)
 
+    def take(self):
+        """Returns and clears the lines received since the last call"""
+        with self.lock:
+            entries = list(self.pending)
+            self.pending.clear()
+        return entries
@@ -0,0 +1,56 @@
+"""SerialTransfer against the pty based FakeESP"""
+
+import os
+import random
+import unittest
+
+from airrohrFlasher.transfer import transfer_session
+
+try:
+    from airrohrFlasher.fakeesp import FakeESP
+except ImportError:
+    # No pseudo terminals (Windows)
+    FakeESP = None
+
+BAUDRATE = 2000000
+WINDOW = 8
+
+
+@unittest.skipIf(FakeESP is None, 'FakeESP needs a pseudo terminal')
+class TransferTest(unittest.TestCase):
+    def transfer(self, content, window=WINDOW, **kwargs):
+        esp = FakeESP(BAUDRATE, write_delay=0, latency=0, **kwargs)
+        esp.start()
+        with transfer_session(esp.device, BAUDRATE,
+                              window=window) as transfer:
+            transfer.put('test.bin', content)
+        return esp, transfer
+
+    def test_windowed(self):
+        content = os.urandom(20000)
+        esp, transfer = self.transfer(content)
+        self.assertEqual(esp.files['test.bin'], content)
+        self.assertEqual(transfer.max_window, esp.window)
+
+    def test_no_query(self):
+        content = os.urandom(5000)
+        esp, transfer = self.transfer(content, window=1)
+        self.assertEqual(esp.files['test.bin'], content)
+        self.assertEqual(transfer.max_window, 1)
+
+    def test_legacy(self):
+        content = os.urandom(5000)
+        esp, transfer = self.transfer(content, windowed=False)
+        self.assertEqual(esp.files['test.bin'], content)
+        self.assertEqual(transfer.max_window, 1)
+
+    def test_failures(self):
+        random.seed(1)
+        content = os.urandom(20000)
+        esp, transfer = self.transfer(content, fail_rate=0.2)
+        self.assertEqual(esp.files['test.bin'], content)
+        self.assertGreater(esp.failures, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()